@@ -0,0 +1,261 @@
+import argparse
+import random
+import re
+from itertools import islice
+from time import perf_counter
+from typing import Iterator, List, Tuple
+
+from index.charset import decode
+from index.codecs import CODEC_CHOICES, decode_list, encode_list
+from index.stemmer import CachedStemmer, CompiledRSLP
+from index.util import fast_tokenize, get_visible, get_visible_soup, ignored_words, member_records, warc_members
+from nltk_light import word_tokenize
+from nltk_light.stem import RSLPStemmer
+from query.index import Index
+
+
+def bench_codecs(index_path: str, every: int):
+    """Re-encode the posting lists of the index with each codec, and report the bits per posting and
+    the decode throughput of each one.
+
+    Args:
+        index_path (str): Path to the index.
+        every (int): Only use every every'th posting list.
+    """
+    index = Index(index_path)
+    size = {codec: 0 for codec in CODEC_CHOICES}
+    decode_time = {codec: 0.0 for codec in CODEC_CHOICES}
+    npostings = 0
+    nlists = 0
+    for i, entry in enumerate(index.entries()):
+        if i % every:
+            continue
+        postings = index.get_value(entry)
+        docids = [docid for docid, _ in postings]
+        counts = [count for _, count in postings]
+        npostings += len(postings)
+        nlists += 1
+        for codec in CODEC_CHOICES:
+            encoded = bytes(encode_list(docids, counts, codec))
+            size[codec] += len(encoded)
+            s = perf_counter()
+            decode_list(encoded)
+            decode_time[codec] += perf_counter() - s
+    index.close()
+
+    print(f"{nlists} posting lists, {npostings} postings")
+    print(f"{'codec':<12}{'MB':>10}{'bits/posting':>14}{'Mpostings/s':>14}")
+    for codec in CODEC_CHOICES:
+        bits = 8 * size[codec] / (npostings or 1)
+        throughput = npostings / (decode_time[codec] or 1e-9) / 10**6
+        print(f"{codec:<12}{size[codec] / 2**20:>10.2f}{bits:>14.2f}{throughput:>14.2f}")
+
+
+def corpus_documents(corpus_path: str, ndocs: int) -> Iterator[Tuple[str, str]]:
+    """(url, decoded payload) of the first ndocs documents of a corpus, no more of the corpus is read.
+
+    Args:
+        corpus_path (str): Path to the zip file containing the warc files.
+        ndocs (int): Number of documents.
+
+    Yields:
+        Tuple[str, str]: The url and the text of each document.
+    """
+    records = (record for member in warc_members(corpus_path) for record in member_records(corpus_path, member))
+    for url, record, payload in islice(records, ndocs):
+        headers = record.http_headers or record.rec_headers
+        yield url, decode(payload.read(), headers.get_header("Content-Type"))
+
+
+def bench_visible(corpus_path: str, ndocs: int, show: int):
+    """Check that get_visible extracts the same text as get_visible_soup, the BeautifulSoup version it
+    replaced, on the first ndocs documents of a corpus, and report the throughput of each one.
+
+    Args:
+        corpus_path (str): Path to the zip file containing the warc files.
+        ndocs (int): Number of documents to compare.
+        show (int): Number of mismatching urls to print.
+    """
+    times = {"html.parser": 0.0, "bs4": 0.0}
+    size = 0
+    compared = 0
+    mismatches = []
+    for url, html in corpus_documents(corpus_path, ndocs):
+        s = perf_counter()
+        text = get_visible(html)
+        times["html.parser"] += perf_counter() - s
+        s = perf_counter()
+        expected = get_visible_soup(html)
+        times["bs4"] += perf_counter() - s
+        if text != expected:
+            mismatches.append(url)
+        size += len(html)
+        compared += 1
+
+    print(f"{compared} documents, {size / 2**20:.2f}M characters, {len(mismatches)} mismatches")
+    for url in mismatches[:show]:
+        print(f"  {url}")
+    print(f"{'extractor':<14}{'docs/s':>10}{'MB/s':>10}")
+    for name, elapsed in times.items():
+        print(f"{name:<14}{compared / (elapsed or 1e-9):>10.1f}{size / 2**20 / (elapsed or 1e-9):>10.2f}")
+
+
+def bench_tokenizers(corpus_path: str, ndocs: int):
+    """Compare fast_tokenize with word_tokenize followed by the token filter and stopword removal of
+    count_worker, on the visible text of the first ndocs documents of a corpus: their throughput, and how
+    much their sets of (lowercased) terms per document agree, before stemming, which both share.
+
+    Args:
+        corpus_path (str): Path to the zip file containing the warc files.
+        ndocs (int): Number of documents to compare.
+    """
+    times = {"word_tokenize": 0.0, "fast": 0.0}
+    size = 0
+    compared = 0
+    common = only_nltk = only_fast = 0
+    for _, html in corpus_documents(corpus_path, ndocs):
+        text = get_visible(html)
+        s = perf_counter()
+        tokens = word_tokenize(text, "portuguese")
+        tokens = [word for word in tokens if not re.search(r"[^\w]|[\d]|\_", word) and word not in ignored_words]
+        times["word_tokenize"] += perf_counter() - s
+        s = perf_counter()
+        _, fast_tokens = fast_tokenize(text)
+        times["fast"] += perf_counter() - s
+        # The stemmer lowercases the terms of word_tokenize.
+        nltk_terms = {word.lower() for word in tokens}
+        fast_terms = set(fast_tokens)
+        common += len(nltk_terms & fast_terms)
+        only_nltk += len(nltk_terms - fast_terms)
+        only_fast += len(fast_terms - nltk_terms)
+        size += len(text)
+        compared += 1
+
+    terms = (common + only_nltk + only_fast) or 1
+    print(f"{compared} documents, {size / 2**20:.2f}M characters of visible text")
+    print(
+        f"term set agreement (jaccard) {common / terms:.3f}, only word_tokenize {only_nltk / terms:.3f}, "
+        f"only fast {only_fast / terms:.3f}"
+    )
+    print(f"{'tokenizer':<16}{'docs/s':>10}{'MB/s':>10}")
+    for name, elapsed in times.items():
+        print(f"{name:<16}{compared / (elapsed or 1e-9):>10.1f}{size / 2**20 / (elapsed or 1e-9):>10.2f}")
+
+
+def rule_words(stemmer: RSLPStemmer, seed: int = 0) -> List[str]:
+    """Words made to exercise every rule of the stemmer: its exceptions, and each suffix after stems of around
+    the minimum size, alone and followed by the suffixes of the steps before it (plurals, feminines...)."""
+    rng = random.Random(seed)
+    letters = "abcdefghijlmnopqrstuvxzáâãçéêíóôõú"
+    suffixes = [rule[0] for rules in stemmer._model for rule in rules]
+    words = set()
+    for rules in stemmer._model:
+        for suffix, min_size, _, exceptions in rules:
+            words.update(exceptions)
+            for size in range(max(0, min_size - 2), min_size + 3):
+                stem = "".join(rng.choice(letters) for _ in range(size))
+                words.add(stem + suffix)
+                words.add(stem + suffix + rng.choice(suffixes))
+                words.add(stem + rng.choice(suffixes) + suffix)
+    words.discard("")
+    return sorted(words)
+
+
+def bench_stemmer(words_path: str, corpus_path: str, ndocs: int, show: int):
+    """Check that CompiledRSLP stems like RSLPStemmer, over a word list (one word per line), the words of the
+    first ndocs documents of a corpus and words made from the rules (see rule_words(/2)), and report the words
+    per second of RSLPStemmer, CompiledRSLP and CachedStemmer over the same words.
+
+    Args:
+        words_path (str): Path to a word list, optional.
+        corpus_path (str): Path to the zip file containing the warc files, optional.
+        ndocs (int): Number of documents to take words from.
+        show (int): Number of mismatching words to print.
+    """
+    reference = RSLPStemmer()
+    words = rule_words(reference)
+    if words_path:
+        with open(words_path, "r", encoding="UTF-8") as f:
+            words += [word for word in f.read().split() if word]
+    occurrences: List[str] = []
+    if corpus_path:
+        for _, html in corpus_documents(corpus_path, ndocs):
+            occurrences += fast_tokenize(get_visible(html))[1]
+    words = sorted(set(words + occurrences))
+
+    compiled = CompiledRSLP(reference)
+    mismatches = [word for word in words if compiled.stem(word) != reference.stem(word)]
+    print(f"{len(words)} distinct words, {len(mismatches)} mismatches")
+    for word in mismatches[:show]:
+        print(f"  {word}: {reference.stem(word)} != {compiled.stem(word)}")
+
+    stream = occurrences or words
+    print(f"{'stemmer':<16}{'distinct words/s':>18}{'occurrences/s':>16}")
+    for name, stemmer in (("rslp", reference), ("compiled", compiled), ("cached", None)):
+        rates = []
+        for sample in (words, stream):
+            stem = (stemmer or CachedStemmer()).stem
+            s = perf_counter()
+            for word in sample:
+                stem(word)
+            rates.append(len(sample) / ((perf_counter() - s) or 1e-9))
+        print(f"{name:<16}{rates[0]:>18.0f}{rates[1]:>16.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the indexer and query processor")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    codecs = subparsers.add_parser("codecs", help="compare the postings codecs on an index")
+    codecs.add_argument(
+        "-i", dest="index_path", action="store", default="final/index", type=str, help="Path to the index file"
+    )
+    codecs.add_argument(
+        "-e", dest="every", action="store", default=1, type=int, help="Only use every e'th posting list"
+    )
+
+    visible = subparsers.add_parser("visible", help="check and time get_visible against the BeautifulSoup version")
+    visible.add_argument(
+        "-c", dest="corpus_path", action="store", required=True, type=str, help="Path to the corpus zip file"
+    )
+    visible.add_argument(
+        "-n", dest="ndocs", action="store", default=1000, type=int, help="Number of documents to compare"
+    )
+    visible.add_argument(
+        "-s", dest="show", action="store", default=10, type=int, help="Number of mismatching urls to print"
+    )
+
+    tokenizers = subparsers.add_parser("tokenizers", help="compare fast_tokenize with word_tokenize")
+    tokenizers.add_argument(
+        "-c", dest="corpus_path", action="store", required=True, type=str, help="Path to the corpus zip file"
+    )
+    tokenizers.add_argument(
+        "-n", dest="ndocs", action="store", default=1000, type=int, help="Number of documents to compare"
+    )
+
+    stemmer = subparsers.add_parser("stemmer", help="check and time the compiled RSLP stemmer against RSLPStemmer")
+    stemmer.add_argument("-w", dest="words_path", action="store", default=None, type=str, help="Path to a word list")
+    stemmer.add_argument(
+        "-c",
+        dest="corpus_path",
+        action="store",
+        default=None,
+        type=str,
+        help="Path to a corpus zip file to take words from",
+    )
+    stemmer.add_argument(
+        "-n", dest="ndocs", action="store", default=1000, type=int, help="Number of documents to take words from"
+    )
+    stemmer.add_argument(
+        "-s", dest="show", action="store", default=10, type=int, help="Number of mismatching words to print"
+    )
+
+    args = parser.parse_args()
+    if args.benchmark == "codecs":
+        bench_codecs(args.index_path, args.every)
+    elif args.benchmark == "visible":
+        bench_visible(args.corpus_path, args.ndocs, args.show)
+    elif args.benchmark == "tokenizers":
+        bench_tokenizers(args.corpus_path, args.ndocs)
+    elif args.benchmark == "stemmer":
+        bench_stemmer(args.words_path, args.corpus_path, args.ndocs, args.show)
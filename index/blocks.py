@@ -0,0 +1,276 @@
+import math
+import struct
+from array import array
+from bisect import bisect_left
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from .codecs import CODECS, CODECS_BY_ID, Codec
+from .postings import decode_varint, encode_varint
+
+# Number of postings per block.
+BLOCK_SIZE = 128
+# BM25 free parameters.
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Block maximum scores (BM25, TF-IDF), before multiplying by the term's idf.
+MAXES = struct.Struct("<ff")
+# Block maximum impacts (BM25, TF-IDF), after the maximum scores if the list has impacts.
+MAX_IMPACTS = struct.Struct("<BB")
+# Set on the codec id byte of lists that store quantized impacts.
+IMPACTS_FLAG = 0x80
+# Largest quantized impact.
+MAX_IMPACT = 255
+# Ratio of the largest to the smallest nonzero impact, and between consecutive ones.
+IMPACT_RANGE = 2.0**20
+STEP = IMPACT_RANGE ** (1 / (MAX_IMPACT - 1))
+
+
+def bm25_tf(tf: float, length: int, avgdl: float) -> float:
+    """The term frequency component of BM25, the idf is applied separately. tf is the count of the
+    term in the document divided by the document's length."""
+    return tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * (length / avgdl)))
+
+
+def bm25_idf(df: int, n: int) -> float:
+    """idf of a term in df of the n documents, for BM25."""
+    return math.log(((n - df + 0.5) / (df + 0.5)) + 1)
+
+
+def tfidf_idf(df: int, n: int) -> float:
+    """idf of a term in df of the n documents, for TF-IDF."""
+    return math.log(n / (df or math.inf))
+
+
+class Impacts(NamedTuple):
+    """Quantization of the per posting scores (idf included): a score is stored in a byte, on a log
+    scale. Code MAX_IMPACT is the largest possible score, each code below it is STEP times smaller,
+    down to code 1, IMPACT_RANGE times smaller. Code 0 is a score of 0. Posting scores are mostly a
+    tiny fraction of the largest possible one, so on a linear scale they would all round to the same
+    few codes, here each one is off by at most half a step (about 3%)."""
+
+    n: int  # Number of documents.
+    bm25_max: float
+    tfidf_max: float
+
+    @classmethod
+    def for_collection(cls, n: int, avgdl: float, min_length: int) -> "Impacts":
+        """Largest possible scores of a posting, that of a term in a single document with a term
+        frequency of 1 and the shortest length."""
+        bm25 = bm25_idf(1, n) * bm25_tf(1.0, max(min_length, 1), avgdl)
+        tfidf = tfidf_idf(1, n)
+        return cls(n, bm25 or 1.0, tfidf or 1.0)
+
+    def quantize(self, score: float, top: float) -> int:
+        """Code of score, top is bm25_max or tfidf_max. Scores under the range get code 1."""
+        if score <= 0:
+            return 0
+        return max(1, min(MAX_IMPACT, MAX_IMPACT + round(math.log(score / top, STEP))))
+
+    def values(self, kind: str) -> List[float]:
+        """Score of each code, kind is "bm25" or "tfidf"."""
+        top = self.bm25_max if kind == "bm25" else self.tfidf_max
+        return [0.0] + [top * STEP ** (code - MAX_IMPACT) for code in range(1, MAX_IMPACT + 1)]
+
+
+def round_up(value: float) -> float:
+    """value rounded so that storing it as a float32 never makes it smaller, block maximums have to
+    stay upper bounds."""
+    return value * (1 + 2**-20) + 2**-126
+
+
+def encode_block_list(
+    docids: Sequence[int],
+    counts: Sequence[int],
+    codec: Codec,
+    lengths: Sequence[int],
+    avgdl: float,
+    impacts: Optional[Impacts] = None,
+    base: int = 0,
+) -> bytearray:
+    nblocks = (len(docids) + BLOCK_SIZE - 1) // BLOCK_SIZE
+    out = bytearray([codec.id | (IMPACTS_FLAG if impacts else 0)])
+    if impacts:
+        bm25_weight = bm25_idf(len(docids), impacts.n)
+        tfidf_weight = tfidf_idf(len(docids), impacts.n)
+    encode_varint(len(docids), out)
+    encode_varint(nblocks, out)
+    body = bytearray()
+    prev = 0
+    for start in range(0, len(docids), BLOCK_SIZE):
+        bdocids = docids[start : start + BLOCK_SIZE]
+        bcounts = counts[start : start + BLOCK_SIZE]
+        size = len(body)
+        # Docids are stored relative to the previous block's last docid.
+        codec.encode_sorted([docid - prev for docid in bdocids], body)
+        codec.encode([count - 1 for count in bcounts], body)
+        blengths = [lengths[docid - base] or 1 for docid in bdocids]
+        tfs = [(count / length, length) for count, length in zip(bcounts, blengths)]
+        bm25 = [bm25_tf(tf, length, avgdl) for tf, length in tfs]
+        tfidf = [tf for tf, _ in tfs]
+        maxes = MAXES.pack(round_up(max(bm25)), round_up(max(tfidf)))
+        if impacts:
+            bm25 = [impacts.quantize(bm25_weight * score, impacts.bm25_max) for score in bm25]
+            tfidf = [impacts.quantize(tfidf_weight * score, impacts.tfidf_max) for score in tfidf]
+            body += bytes(bm25)
+            body += bytes(tfidf)
+            maxes += MAX_IMPACTS.pack(max(bm25), max(tfidf))
+        encode_varint(bdocids[-1] - prev, out)
+        encode_varint(len(body) - size, out)
+        out += maxes
+        prev = bdocids[-1]
+    out += body
+    return out
+
+
+def encode_blocks(
+    docids: Sequence[int],
+    counts: Sequence[int],
+    codec: str,
+    lengths: Sequence[int],
+    avgdl: float,
+    impacts: Optional[Impacts] = None,
+    base: int = 0,
+) -> bytearray:
+    """Encode a posting list in blocks of BLOCK_SIZE postings. The list starts with the codec id, the
+    number of postings and of blocks, then a skip entry per block (its last docid and its length in
+    bytes, varint encoded relative to the previous block, and the block's maximum BM25 and TF-IDF
+    term frequency components as float32) followed by the blocks encoded by the codec. Blocks can be
+    skipped, or pruned by their maximum score, without being decoded.
+
+    If impacts is given, each block also stores the quantized BM25 and TF-IDF score (idf included)
+    of each posting, a byte each, and its skip entry the maximum impacts too, after the maximum term
+    frequency components.
+
+    Args:
+        docids (Sequence[int]): Increasing docids.
+        counts (Sequence[int]): Count of the term in each document.
+        codec (str): Name of the codec, or "adaptive" to use the codec that gives the smallest list.
+        lengths (Sequence[int]): Length of each document, indexed by docid - base.
+        avgdl (float): Average document length.
+        impacts (Impacts, optional): Quantization of the impacts, if they are stored.
+        base (int, optional): First docid of the index. Defaults to 0.
+
+    Returns:
+        bytearray: The encoded posting list.
+    """
+    if codec != "adaptive":
+        return encode_block_list(docids, counts, CODECS[codec], lengths, avgdl, impacts, base)
+    return min(
+        (encode_block_list(docids, counts, c, lengths, avgdl, impacts, base) for c in CODECS.values()), key=len
+    )
+
+
+class PostingList:
+    """Posting list encoded by encode_blocks. Only the skip entries are decoded up front, blocks are
+    decoded when first accessed."""
+
+    def __init__(self, buf) -> None:
+        self.buf = buf
+        self.codec = CODECS_BY_ID[buf[0] & ~IMPACTS_FLAG]
+        self.has_impacts = bool(buf[0] & IMPACTS_FLAG)
+        self.n, pos = decode_varint(buf, 1)
+        nblocks, pos = decode_varint(buf, pos)
+        self.lasts = array("Q")
+        self.starts = array("Q")
+        self.bm25_max: List[float] = []
+        self.tfidf_max: List[float] = []
+        self.bm25_impact_max = bytearray()
+        self.tfidf_impact_max = bytearray()
+        last = start = 0
+        for _ in range(nblocks):
+            gap, pos = decode_varint(buf, pos)
+            size, pos = decode_varint(buf, pos)
+            bm25, tfidf = MAXES.unpack_from(buf, pos)
+            pos += MAXES.size
+            if self.has_impacts:
+                bm25_impact, tfidf_impact = MAX_IMPACTS.unpack_from(buf, pos)
+                pos += MAX_IMPACTS.size
+                self.bm25_impact_max.append(bm25_impact)
+                self.tfidf_impact_max.append(tfidf_impact)
+            last += gap
+            self.lasts.append(last)
+            self.starts.append(start)
+            self.bm25_max.append(bm25)
+            self.tfidf_max.append(tfidf)
+            start += size
+        self.starts = array("Q", [start + pos for start in self.starts])
+
+    def block(self, i: int) -> Tuple[List[int], List[int], Optional[bytes], Optional[bytes]]:
+        """Decode block i into its docids, counts, and BM25 and TF-IDF impacts (None if the list has no
+        impacts)."""
+        base = self.lasts[i - 1] if i else 0
+        n = min(BLOCK_SIZE, self.n - i * BLOCK_SIZE)
+        docids, pos = self.codec.decode_sorted(self.buf, self.starts[i], n)
+        counts, pos = self.codec.decode(self.buf, pos, n)
+        bm25 = tfidf = None
+        if self.has_impacts:
+            bm25 = bytes(self.buf[pos : pos + n])
+            tfidf = bytes(self.buf[pos + n : pos + 2 * n])
+        return [docid + base for docid in docids], [count + 1 for count in counts], bm25, tfidf
+
+    def postings(self) -> List[Tuple[int, int]]:
+        """Decode the whole list into (docid, count) pairs."""
+        postings = []
+        for i in range(len(self.lasts)):
+            docids, counts, _, _ = self.block(i)
+            postings.extend(zip(docids, counts))
+        return postings
+
+    def cursor(self) -> "PostingCursor":
+        return PostingCursor(self)
+
+    def __len__(self) -> int:
+        return self.n
+
+
+class PostingCursor:
+    """Forward cursor over a PostingList, that moves between blocks using their skip entries."""
+
+    def __init__(self, plist: PostingList) -> None:
+        self.plist = plist
+        self.bi = 0
+        self.decoded = -1
+        self.docids: List[int] = []
+        self.counts: List[int] = []
+        self.impacts = {"bm25": b"", "tfidf": b""}
+        self.i = 0
+        self.docid: Optional[int] = None
+        self.count = 0
+
+    def seek_block(self, target: int) -> bool:
+        """Move to the first block whose last docid is >= target, without decoding it.
+        Returns False if there is no such block."""
+        lasts = self.plist.lasts
+        if self.bi < len(lasts) and lasts[self.bi] < target:
+            self.bi = bisect_left(lasts, target, self.bi)
+        return self.bi < len(lasts)
+
+    def block_last(self) -> int:
+        return self.plist.lasts[self.bi]
+
+    def block_max(self, kind: str) -> float:
+        """Maximum term frequency component of the current block, kind is "bm25" or "tfidf"."""
+        return self.plist.bm25_max[self.bi] if kind == "bm25" else self.plist.tfidf_max[self.bi]
+
+    def block_max_impact(self, kind: str) -> int:
+        """Maximum impact of the current block, if the list has impacts, kind is "bm25" or "tfidf"."""
+        return self.plist.bm25_impact_max[self.bi] if kind == "bm25" else self.plist.tfidf_impact_max[self.bi]
+
+    def next_geq(self, target: int) -> Optional[int]:
+        """Move to the first posting with docid >= target, decoding only the block that holds it.
+        Returns its docid, or None if there is none."""
+        if not self.seek_block(target):
+            self.docid = None
+            return None
+        if self.decoded != self.bi:
+            self.docids, self.counts, self.impacts["bm25"], self.impacts["tfidf"] = self.plist.block(self.bi)
+            self.decoded = self.bi
+            self.i = 0
+        self.i = bisect_left(self.docids, target, self.i)
+        self.docid = self.docids[self.i]
+        self.count = self.counts[self.i]
+        return self.docid
+
+    def impact(self, kind: str) -> int:
+        """Quantized score of the current posting, kind is "bm25" or "tfidf"."""
+        return self.impacts[kind][self.i]
@@ -0,0 +1,202 @@
+import json
+import os
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Progress manifest of a build, in the cache directory.
+PROGRESS = "progress"
+# Build phases, in order. Counting inverts the documents into runs, merging turns them into the index.
+PHASES = ("count", "merge", "done")
+
+
+def build_config(
+    corpus_path: str,
+    out: str,
+    base: int,
+    plaintext: bool,
+    dedup: str = "off",
+    near: bool = False,
+    tokenizer: str = "nltk",
+) -> Dict:
+    """What a build's docids and runs depend on. A checkpoint is only resumed by a build with the same
+    config, the codec and impacts only matter to the final merge, which is always redone."""
+    stat = os.stat(corpus_path)
+    return {
+        "corpus": os.path.abspath(corpus_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "out": out,
+        "base": base,
+        "plaintext": plaintext,
+        "dedup": dedup,
+        "near": near,
+        "tokenizer": tokenizer,
+    }
+
+
+def pending_build(cache: str) -> Optional[Dict]:
+    """Config of the unfinished build whose checkpoint is in cache, if any."""
+    path = os.path.join(cache, PROGRESS)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="UTF-8") as f:
+        state = json.load(f)
+    return state["config"] if state["phase"] != "done" else None
+
+
+class Checkpoint:
+    """Progress of an index build, persisted to {cache}/progress as JSON after every step, so a build
+    that dies (a MemoryError, preemption...) can be resumed from the last consistent state.
+
+    It records the WARC members already scanned, with their docid ranges (their urls and document
+    signatures are kept in {cache}/urls, so they are not scanned again), the docid ranges already
+    counted, the partial counts and runs written for them, and the merge passes completed. Files of the cache that
+    are not in the manifest were written after the last checkpoint and are removed when resuming.
+    """
+
+    def __init__(self, cache: str, config: Dict, state: Optional[Dict] = None) -> None:
+        self.cache = cache
+        self.state = state or {
+            "config": config,
+            "phase": PHASES[0],
+            "members": {},
+            "counted": [],
+            "counts": [],
+            "runs": [],
+            "passes": 0,
+        }
+        os.makedirs(os.path.join(cache, "urls"), exist_ok=True)
+
+    @classmethod
+    def open(cls, cache: str, config: Dict, resume: bool = False) -> "Checkpoint":
+        """The checkpoint in cache if resume is True and it was written by a build with the same config,
+        else a new one. Resuming removes the files written after the checkpoint.
+
+        Args:
+            cache (str): Cache directory of the build.
+            config (Dict): Config of the build, see build_config(/4).
+            resume (bool, optional): If the build resumes from the checkpoint. Defaults to False.
+        """
+        path = os.path.join(cache, PROGRESS)
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding="UTF-8") as f:
+                state = json.load(f)
+            if state["config"] == config:
+                checkpoint = cls(cache, config, state)
+                checkpoint.clean()
+                print(f"Resuming from the {checkpoint.phase} phase")
+                if checkpoint.phase == "count":
+                    print(f"{checkpoint.ncounted()} documents already counted")
+                return checkpoint
+            print("The checkpoint is of a different build, starting over")
+        checkpoint = cls(cache, config)
+        checkpoint.clean()
+        checkpoint.save()
+        return checkpoint
+
+    def save(self) -> None:
+        """Write the manifest atomically, so a crash leaves either the old or the new checkpoint."""
+        path = os.path.join(self.cache, PROGRESS)
+        with open(path + ".tmp", "w", encoding="UTF-8") as f:
+            json.dump(self.state, f)
+        os.replace(path + ".tmp", path)
+
+    def clean(self) -> None:
+        """Remove the partial counts and runs that are not in the manifest."""
+        for directory, names in (("partial_counts", self.state["counts"]), ("runs", self.state["runs"])):
+            keep = set(names)
+            path = os.path.join(self.cache, directory)
+            for filename in os.listdir(path):
+                if filename not in keep:
+                    os.remove(os.path.join(path, filename))
+
+    @property
+    def phase(self) -> str:
+        return self.state["phase"]
+
+    @phase.setter
+    def phase(self, phase: str) -> None:
+        self.state["phase"] = phase
+        self.save()
+
+    def ncounted(self) -> int:
+        return sum(hi - lo for lo, hi in self.state["counted"])
+
+    def is_counted(self, start: int, end: int) -> bool:
+        """If the documents [start, end) are all in a counted range. O(log nranges)"""
+        if start == end:
+            return True
+        counted = self.state["counted"]
+        i = bisect_right(counted, [start, float("inf")]) - 1
+        return i >= 0 and end <= counted[i][1]
+
+    def url_path(self, member: str) -> str:
+        return os.path.join(self.cache, "urls", member.replace("/", "_"))
+
+    def read_member(
+        self, member: str, start: int, end: int, urls: List[str], signatures: Optional[List] = None
+    ) -> None:
+        """Record the docid range [start, end) given to the documents of member, their urls and their signatures
+        if they were deduplicated (see index.dedup.Deduplicator)."""
+        if signatures is not None:
+            with open(self.url_path(member) + ".sig.tmp", "w", encoding="UTF-8") as f:
+                json.dump(signatures, f)
+            os.replace(self.url_path(member) + ".sig.tmp", self.url_path(member) + ".sig")
+        with open(self.url_path(member) + ".tmp", "w", encoding="UTF-8") as f:
+            f.writelines(url + "\n" for url in urls)
+        os.replace(self.url_path(member) + ".tmp", self.url_path(member))
+        self.state["members"][member] = [start, end]
+
+    def is_scanned(self, member: str) -> bool:
+        return member in self.state["members"]
+
+    def member_scan(self, member: str) -> Optional[Tuple[List[str], Optional[List]]]:
+        """The urls of the documents of member and their signatures (None if they were not deduplicated) if it
+        was already scanned, else None."""
+        if not self.is_scanned(member):
+            return None
+        with open(self.url_path(member), "r", encoding="UTF-8") as f:
+            urls = f.read().splitlines()
+        signatures = None
+        if os.path.exists(self.url_path(member) + ".sig"):
+            with open(self.url_path(member) + ".sig", "r", encoding="UTF-8") as f:
+                signatures = json.load(f)
+        return urls, signatures
+
+    def add_counted(self, batches: Iterable[Tuple[int, int, List[str]]]) -> None:
+        """Record batches of documents as counted, each as its docid range [lo, hi) and the names of the
+        partial counts and runs written for it (they are named alike, see index.spimi.SpimiInverter)."""
+        counted = self.state["counted"]
+        for lo, hi, names in batches:
+            counted.append([lo, hi])
+            self.state["counts"].extend(names)
+            self.state["runs"].extend(names)
+        counted.sort()
+        merged: List[List[int]] = []
+        for lo, hi in counted:
+            if merged and lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        self.state["counted"] = merged
+        self.save()
+
+    def finish_count(self) -> None:
+        """Record that every document was counted. The runs and partial counts on disk are then complete."""
+        self.state["counts"] = self.files("partial_counts")
+        self.state["runs"] = self.files("runs")
+        self.phase = "merge"
+
+    def files(self, directory: str) -> List[str]:
+        names = os.listdir(os.path.join(self.cache, directory))
+        return sorted(name for name in names if not name.endswith(".tmp"))
+
+    def merged_runs(self, names: List[str], name: str) -> None:
+        """Record that the runs names were merged into the run name, before they are deleted."""
+        merged = set(names)
+        self.state["runs"] = [run for run in self.state["runs"] if run not in merged] + [name]
+        self.save()
+
+    def finished_pass(self) -> None:
+        self.state["passes"] += 1
+        self.save()
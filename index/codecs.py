@@ -0,0 +1,321 @@
+import struct
+from typing import Dict, List, Sequence, Tuple
+
+from .postings import decode_varint, encode_varint
+
+# Posting lists shorter than this are always encoded with VByte by the adaptive codec, since the
+# other codecs' headers would outweigh any gains.
+ADAPTIVE_MIN_LENGTH = 8
+
+
+class BitWriter:
+    """Appends values of arbitrary bit widths to a bytearray, least significant bit first."""
+
+    def __init__(self, out: bytearray) -> None:
+        self.out = out
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value: int, bits: int) -> None:
+        self.acc |= value << self.nbits
+        self.nbits += bits
+        while self.nbits >= 8:
+            self.out.append(self.acc & 0xFF)
+            self.acc >>= 8
+            self.nbits -= 8
+
+    def flush(self) -> None:
+        if self.nbits:
+            self.out.append(self.acc & 0xFF)
+        self.acc = self.nbits = 0
+
+
+class BitReader:
+    """Reads values written by BitWriter from buf, starting at byte pos."""
+
+    def __init__(self, buf, pos: int) -> None:
+        self.buf = buf
+        self.pos = pos
+        self.acc = 0
+        self.nbits = 0
+
+    def read(self, bits: int) -> int:
+        while self.nbits < bits:
+            self.acc |= self.buf[self.pos] << self.nbits
+            self.pos += 1
+            self.nbits += 8
+        value = self.acc & ((1 << bits) - 1)
+        self.acc >>= bits
+        self.nbits -= bits
+        return value
+
+
+def deltas(values: Sequence[int]) -> List[int]:
+    """Gaps between consecutive values, the first one relative to 0."""
+    return [b - a for a, b in zip([0, *values], values)]
+
+
+def prefix_sums(values: Sequence[int]) -> List[int]:
+    out = []
+    acc = 0
+    for value in values:
+        acc += value
+        out.append(acc)
+    return out
+
+
+class Codec:
+    """Encodes sequences of non negative integers. Encodings are not self delimiting, the number of
+    values has to be known to decode them. Increasing sequences (docids) are encoded as gaps by
+    default, codecs that work on increasing sequences override encode_sorted/decode_sorted."""
+
+    id = -1
+    name = ""
+
+    def encode(self, values: Sequence[int], out: bytearray) -> None:
+        raise NotImplementedError
+
+    def decode(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        """Decode n values from buf starting at pos. Returns the values and the position after them."""
+        raise NotImplementedError
+
+    def encode_sorted(self, values: Sequence[int], out: bytearray) -> None:
+        self.encode(deltas(values), out)
+
+    def decode_sorted(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        values, pos = self.decode(buf, pos, n)
+        return prefix_sums(values), pos
+
+
+class VByte(Codec):
+    """Variable byte: 7 bits per byte, high bit set on every byte but the last of each value."""
+
+    id = 0
+    name = "vbyte"
+
+    def encode(self, values: Sequence[int], out: bytearray) -> None:
+        for value in values:
+            encode_varint(value, out)
+
+    def decode(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        values = []
+        for _ in range(n):
+            value, pos = decode_varint(buf, pos)
+            values.append(value)
+        return values, pos
+
+
+# Simple8b selectors: (number of values, bits per value) packed in the 60 data bits of a word.
+SIMPLE8B = [(240, 0), (120, 0), (60, 1), (30, 2), (20, 3), (15, 4), (12, 5), (10, 6), (8, 7), (7, 8),
+            (6, 10), (5, 12), (4, 15), (3, 20), (2, 30), (1, 60)]  # fmt: skip
+WORD = struct.Struct("<Q")
+
+
+class Simple8b(Codec):
+    """Simple8b word packing: each 64 bit word holds a 4 bit selector and as many values of the same
+    bit width as fit in the remaining 60 bits. Values must be smaller than 2**60."""
+
+    id = 1
+    name = "simple8b"
+
+    def encode(self, values: Sequence[int], out: bytearray) -> None:
+        i = 0
+        n = len(values)
+        while i < n:
+            for selector, (count, bits) in enumerate(SIMPLE8B):
+                # The last word may hold fewer values than its selector allows.
+                chunk = values[i : i + count]
+                limit = 1 << bits
+                if all(value < limit for value in chunk):
+                    break
+            word = selector << 60
+            for j, value in enumerate(chunk):
+                word |= value << (j * bits)
+            out += WORD.pack(word)
+            i += len(chunk)
+
+    def decode(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        values: List[int] = []
+        while len(values) < n:
+            (word,) = WORD.unpack_from(buf, pos)
+            pos += 8
+            count, bits = SIMPLE8B[word >> 60]
+            count = min(count, n - len(values))
+            if not bits:
+                values.extend([0] * count)
+                continue
+            mask = (1 << bits) - 1
+            for j in range(count):
+                values.append((word >> (j * bits)) & mask)
+        return values, pos
+
+
+# Positions of the set bits of each byte value, to decode unary codes a byte at a time.
+SET_BITS = [[bit for bit in range(8) if byte >> bit & 1] for byte in range(256)]
+
+
+class EliasFano(Codec):
+    """Elias-Fano encoding of increasing sequences: the low log2(universe / n) bits of each value are
+    stored verbatim, the high bits as unary coded gaps. Arbitrary sequences are encoded as their
+    prefix sums."""
+
+    id = 2
+    name = "eliasfano"
+
+    def encode_sorted(self, values: Sequence[int], out: bytearray) -> None:
+        n = len(values)
+        universe = values[-1] if n else 0
+        low = max(0, (universe // n).bit_length() - 1) if n else 0
+        encode_varint(universe, out)
+        encode_varint(low, out)
+        writer = BitWriter(out)
+        if low:
+            mask = (1 << low) - 1
+            for value in values:
+                writer.write(value & mask, low)
+            writer.flush()
+        last = 0
+        for value in values:
+            high = value >> low
+            writer.write(1 << (high - last), high - last + 1)
+            last = high
+        writer.flush()
+
+    def decode_sorted(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        if not n:
+            _, pos = decode_varint(buf, pos)
+            _, pos = decode_varint(buf, pos)
+            return [], pos
+        _, pos = decode_varint(buf, pos)
+        low, pos = decode_varint(buf, pos)
+        lows = [0] * n
+        if low:
+            reader = BitReader(buf, pos)
+            lows = [reader.read(low) for _ in range(n)]
+            pos = reader.pos
+        values = []
+        i = 0
+        base = 0
+        while i < n:
+            for bit in SET_BITS[buf[pos]]:
+                values.append(((base + bit - i) << low) | lows[i])
+                i += 1
+                if i == n:
+                    break
+            base += 8
+            pos += 1
+        return values, pos
+
+    def encode(self, values: Sequence[int], out: bytearray) -> None:
+        self.encode_sorted(prefix_sums(values), out)
+
+    def decode(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        values, pos = self.decode_sorted(buf, pos, n)
+        return deltas(values), pos
+
+
+class PForDelta(Codec):
+    """Patched frame of reference in blocks of 128 values: each block stores the low b bits of every
+    value, b chosen so that about 90% of the block fits, and patches the exceptions with their
+    positions and high bits."""
+
+    id = 3
+    name = "pfordelta"
+    block = 128
+
+    def encode(self, values: Sequence[int], out: bytearray) -> None:
+        for start in range(0, len(values), self.block):
+            chunk = values[start : start + self.block]
+            widths = sorted(value.bit_length() for value in chunk)
+            bits = widths[min(len(widths) - 1, (len(widths) * 9) // 10)]
+            exceptions = [(j, value >> bits) for j, value in enumerate(chunk) if value >> bits]
+            encode_varint(bits, out)
+            encode_varint(len(exceptions), out)
+            if bits:
+                writer = BitWriter(out)
+                mask = (1 << bits) - 1
+                for value in chunk:
+                    writer.write(value & mask, bits)
+                writer.flush()
+            for j, high in exceptions:
+                out.append(j)
+                encode_varint(high, out)
+
+    def decode(self, buf, pos: int, n: int) -> Tuple[List[int], int]:
+        values: List[int] = []
+        while len(values) < n:
+            count = min(self.block, n - len(values))
+            bits, pos = decode_varint(buf, pos)
+            nexceptions, pos = decode_varint(buf, pos)
+            if bits:
+                reader = BitReader(buf, pos)
+                chunk = [reader.read(bits) for _ in range(count)]
+                pos = reader.pos
+            else:
+                chunk = [0] * count
+            for _ in range(nexceptions):
+                j = buf[pos]
+                high, pos = decode_varint(buf, pos + 1)
+                chunk[j] |= high << bits
+            values.extend(chunk)
+        return values, pos
+
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (VByte(), Simple8b(), EliasFano(), PForDelta())}
+CODECS_BY_ID: Dict[int, Codec] = {codec.id: codec for codec in CODECS.values()}
+# Codec names accepted when building an index, "adaptive" picks a codec per posting list.
+CODEC_CHOICES = [*CODECS, "adaptive"]
+
+
+def encode_columns(docids: Sequence[int], counts: Sequence[int], codec: Codec) -> bytearray:
+    """Encode docids and counts with codec. Counts are at least 1, so count - 1 is stored."""
+    out = bytearray()
+    codec.encode_sorted(docids, out)
+    codec.encode([count - 1 for count in counts], out)
+    return out
+
+
+def encode_list(docids: Sequence[int], counts: Sequence[int], codec: str = "vbyte") -> bytearray:
+    """Encode a posting list as the codec id, the number of postings, then the docids and the counts
+    encoded by the codec.
+
+    Args:
+        docids (Sequence[int]): Increasing docids.
+        counts (Sequence[int]): Count of the term in each document.
+        codec (str, optional): Name of the codec, or "adaptive" to use VByte for short lists and the
+            codec giving the smallest encoding (which depends on the gap distribution) for long ones.
+            Defaults to "vbyte".
+
+    Returns:
+        bytearray: The encoded posting list.
+    """
+    if codec == "adaptive":
+        if len(docids) < ADAPTIVE_MIN_LENGTH:
+            best = CODECS["vbyte"]
+            body = encode_columns(docids, counts, best)
+        else:
+            best, body = min(
+                ((c, encode_columns(docids, counts, c)) for c in CODECS.values()), key=lambda pair: len(pair[1])
+            )
+    else:
+        best = CODECS[codec]
+        body = encode_columns(docids, counts, best)
+    out = bytearray([best.id])
+    encode_varint(len(docids), out)
+    out += body
+    return out
+
+
+def decode_columns(buf) -> Tuple[List[int], List[int]]:
+    """Decode a posting list encoded by encode_list into its docids and counts."""
+    codec = CODECS_BY_ID[buf[0]]
+    n, pos = decode_varint(buf, 1)
+    docids, pos = codec.decode_sorted(buf, pos, n)
+    counts, _ = codec.decode(buf, pos, n)
+    return docids, [count + 1 for count in counts]
+
+
+def decode_list(buf) -> List[Tuple[int, int]]:
+    """Decode a posting list encoded by encode_list into (docid, count) pairs."""
+    return list(zip(*decode_columns(buf)))
+
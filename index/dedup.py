@@ -0,0 +1,159 @@
+import re
+from array import array
+from collections import Counter
+from hashlib import blake2b
+from typing import Dict, List, Optional, Tuple
+
+# What is done with duplicate documents: "off" indexes them, "alias" writes their urls to {out}/aliases with
+# the docid of the document they duplicate, "skip" only counts them.
+DEDUP_MODES = ("off", "alias", "skip")
+# Words per shingle of the SimHash of a document.
+SHINGLE_SIZE = 3
+# Documents with fewer shingles have no SimHash, short texts are too alike to tell near duplicates apart.
+MIN_SHINGLES = 8
+# Documents whose SimHashes differ in at most NEAR_DISTANCE of their 64 bits are near duplicates.
+NEAR_DISTANCE = 3
+# The SimHash is split in NEAR_DISTANCE + 1 blocks of BLOCK_BITS, near duplicates share at least one of them.
+BLOCK_BITS = 64 // (NEAR_DISTANCE + 1)
+WORD = re.compile(r"\w+")
+
+
+def hash64(data: bytes) -> int:
+    """Nonzero 64 bit hash of data (0 marks the empty slots of a SignatureTable)."""
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "little") or 1
+
+
+def exact_signature(payload: bytes) -> int:
+    """Signature of byte-identical documents. O(len(payload))"""
+    return hash64(payload)
+
+
+def near_signature(text: str) -> Optional[int]:
+    """SimHash of the shingles of SHINGLE_SIZE words of text: bit i is set if most shingle hashes have their
+    bit i set, so texts that share most of their shingles have SimHashes a few bits apart. None if text has
+    fewer than MIN_SHINGLES shingles. O(len(text))
+
+    The bits are counted a nibble at a time, 16 additions per shingle instead of 64.
+    """
+    words = WORD.findall(text.lower())
+    shingles = {" ".join(words[i : i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    nibbles = [0] * (16 * 16)
+    for shingle in shingles:
+        h = hash64(shingle.encode("UTF-8"))
+        for position in range(0, 256, 16):
+            nibbles[position + (h & 15)] += 1
+            h >>= 4
+    simhash = 0
+    half = len(shingles) / 2
+    for bit in range(64):
+        position, mask = 16 * (bit // 4), 1 << (bit % 4)
+        if sum(nibbles[position + value] for value in range(16) if value & mask) > half:
+            simhash |= 1 << bit
+    return simhash
+
+
+class SignatureTable:
+    """Map of nonzero 64 bit signatures to docids, in two arrays with open addressing (linear probing), about
+    24 bytes per document instead of the ~100 of a dict."""
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self.keys = array("Q", bytes(8 * capacity))
+        self.values = array("q", bytes(8 * capacity))
+        self.n = 0
+
+    def slot(self, key: int) -> int:
+        mask = len(self.keys) - 1
+        i = key & mask
+        while self.keys[i] and self.keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, key: int) -> Optional[int]:
+        i = self.slot(key)
+        return self.values[i] if self.keys[i] else None
+
+    def add(self, key: int, value: int) -> None:
+        if 3 * (self.n + 1) > 2 * len(self.keys):
+            keys, values = self.keys, self.values
+            self.keys = array("Q", bytes(16 * len(keys)))
+            self.values = array("q", bytes(16 * len(keys)))
+            for old, docid in zip(keys, values):
+                if old:
+                    i = self.slot(old)
+                    self.keys[i] = old
+                    self.values[i] = docid
+        i = self.slot(key)
+        if not self.keys[i]:
+            self.n += 1
+        self.keys[i] = key
+        self.values[i] = value
+
+
+class SimHashIndex:
+    """SimHashes of the documents indexed, searchable for one at most NEAR_DISTANCE bits away. Two SimHashes that
+    close are equal in at least one of their NEAR_DISTANCE + 1 blocks of bits, so only the documents sharing a
+    block are compared. The SimHashes and docids are kept in arrays, each block maps its values to the positions
+    of the documents in them."""
+
+    def __init__(self) -> None:
+        self.hashes = array("Q")
+        self.docids = array("q")
+        self.blocks: List[Dict[int, array]] = [{} for _ in range(NEAR_DISTANCE + 1)]
+
+    def find(self, simhash: int) -> Optional[int]:
+        """Docid of a document whose SimHash is at most NEAR_DISTANCE bits from simhash, if any."""
+        mask = (1 << BLOCK_BITS) - 1
+        for block, positions in enumerate(self.blocks):
+            for i in positions.get((simhash >> (block * BLOCK_BITS)) & mask, ()):
+                if bin(self.hashes[i] ^ simhash).count("1") <= NEAR_DISTANCE:
+                    return self.docids[i]
+        return None
+
+    def add(self, simhash: int, docid: int) -> None:
+        mask = (1 << BLOCK_BITS) - 1
+        for block, positions in enumerate(self.blocks):
+            positions.setdefault((simhash >> (block * BLOCK_BITS)) & mask, array("I")).append(len(self.hashes))
+        self.hashes.append(simhash)
+        self.docids.append(docid)
+
+
+class Deduplicator:
+    """Finds the documents that duplicate one seen before them: byte-identical ones by their exact signature, and,
+    if near is set, ones with almost the same text by their SimHash (see near_signature(/1)). The first document
+    of a group is the canonical one, the one indexed.
+    """
+
+    def __init__(self, near: bool = False) -> None:
+        self.exact = SignatureTable()
+        self.near = SimHashIndex() if near else None
+        self.stats: Counter = Counter()
+
+    def check(self, signature: Tuple[int, Optional[int]], docid: int) -> Optional[int]:
+        """Docid of the document that the document with signature duplicates, None if it is not a duplicate, in which
+        case it is added as docid. O(1) for exact duplicates, O(ndocs / 2**BLOCK_BITS) for near ones.
+
+        Args:
+            signature (Tuple[int, Optional[int]]): Its exact signature and SimHash (see exact_signature(/1) and
+                near_signature(/1)).
+            docid (int): Docid the document gets if it is not a duplicate.
+
+        Returns:
+            Optional[int]: The canonical docid, or None. Counted in self.stats as "dedup.exact", "dedup.near" or
+                "dedup.unique".
+        """
+        exact, simhash = signature
+        canonical = self.exact.get(exact)
+        if canonical is not None:
+            self.stats["dedup.exact"] += 1
+            return canonical
+        if self.near is not None and simhash is not None:
+            canonical = self.near.find(simhash)
+            if canonical is not None:
+                self.stats["dedup.near"] += 1
+                return canonical
+            self.near.add(simhash, docid)
+        self.exact.add(exact, docid)
+        self.stats["dedup.unique"] += 1
+        return None
@@ -1,53 +1,185 @@
-import ast
+import heapq
 import os
+import struct
+from bisect import bisect_left
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .postings import decode_postings, decode_varint, encode_postings, encode_varint
+
+MEGABYTE = 1024 * 1024
+# Upper bound on the size of a record header without its term: four varints.
+HEADER_SIZE = 40
+# Trailer footer: offset where the records end, number of fences, magic.
+FOOTER = struct.Struct("<QQ4s")
+MAGIC = b"RUN1"
+# Every FENCE_INTERVAL'th record has its term and offset written to the trailer.
+FENCE_INTERVAL = 64
+
+
+class RunWriter:
+    """Writes a run (partial index) in the binary run format. Each record holds a term followed by the
+    varint encoded document frequency, collection frequency, last docid and length in bytes of the
+    posting list, then the posting list as encoded by encode_postings. Terms must be added in order.
+
+    The records are followed by a trailer with the term and offset of every FENCE_INTERVAL'th record
+    (fences), used to sample runs and to start reading them from a given term, and a fixed size footer."""
+
+    def __init__(self, path: str) -> None:
+        self.fp = open(path, "wb")
+        self.pos = 0
+        self.records = 0
+        self.fences = bytearray()
+
+    def add(self, term: str, postings: List[Tuple[int, int]]) -> None:
+        self.add_encoded(
+            term, len(postings), sum(c for _, c in postings), postings[-1][0], encode_postings(postings)
+        )
+
+    def add_encoded(self, term: str, df: int, cf: int, last: int, payload) -> None:
+        encoded = term.encode("UTF-8")
+        header = bytearray()
+        encode_varint(len(encoded), header)
+        header += encoded
+        for value in (df, cf, last, len(payload)):
+            encode_varint(value, header)
+        if not self.records % FENCE_INTERVAL:
+            encode_varint(len(encoded), self.fences)
+            self.fences += encoded
+            encode_varint(self.pos, self.fences)
+        self.records += 1
+        self.fp.write(header)
+        self.fp.write(payload)
+        self.pos += len(header) + len(payload)
+
+    def close(self) -> None:
+        self.fp.write(self.fences)
+        self.fp.write(FOOTER.pack(self.pos, (self.records + FENCE_INTERVAL - 1) // FENCE_INTERVAL, MAGIC))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
 
 class FileBuffer:
-    """File buffer for count files and partial indexes. Hashable by docid, and comparable by
-    token then (if the token is equal) docid."""
+    """File buffer for runs in the binary run format. Reads the file in blocks of block_size bytes and
+    parses records out of the block, so there is one read call per block rather than per character.
+    Hashable by docid, and comparable by token then (if the token is equal) docid.
+
+    If lo is given the buffer starts on the first token >= lo, found through the run's fences, and if
+    hi is given it ends before the first token >= hi.
 
-    def __init__(self, fdir: str, filename: str):
+    Counts the records and bytes consumed, see rate(/0)."""
+
+    def __init__(
+        self, fdir: str, filename: str, block_size: int = MEGABYTE, lo: Optional[str] = None, hi: Optional[str] = None
+    ):
         self.id = int(filename.split(sep="_")[0])
+        self.block_size = block_size
+        self.hi = hi
+        self.buf = b""
+        self.pos = 0
+        self.records = 0
+        self.bytes = 0
+        self.start = time()
+        self.token = None
         try:
-            self.fp = open(os.path.join(fdir, filename), "r", encoding="UTF-8")
+            self.fp = open(os.path.join(fdir, filename), "rb", buffering=0)
         except FileNotFoundError:
-            self.token = None
+            self.fp = None
             return
-        self.token = None
+        self.end, nfences = self.footer()
+        self.read_pos = 0
+        if lo is not None:
+            fences = self.fences(nfences)
+            i = bisect_left([term for term, _ in fences], lo) - 1
+            if i >= 0:
+                self.read_pos = fences[i][1]
+                self.fp.seek(self.read_pos)
         self.next()
+        while self.token is not None and lo is not None and self.token < lo:
+            self.next()
 
-    def close(self):
-        self.fp.close()
+    def footer(self) -> Tuple[int, int]:
+        """Offset where the records end, and number of fences."""
+        size = os.fstat(self.fp.fileno()).st_size
+        if size < FOOTER.size:
+            return 0, 0
+        self.fp.seek(size - FOOTER.size)
+        end, nfences, magic = FOOTER.unpack(self.fp.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.fp.name} is not a run")
+        self.fp.seek(0)
+        return end, nfences
 
-    def value(self):
-        line = self.fp.readline()
+    def fences(self, nfences: int) -> List[Tuple[str, int]]:
+        """Read the (term, offset) fences of the run."""
+        self.fp.seek(self.end)
+        buf = self.fp.read()
+        fences = []
+        pos = 0
+        for _ in range(nfences):
+            size, pos = decode_varint(buf, pos)
+            term = buf[pos : pos + size].decode("UTF-8")
+            offset, pos = decode_varint(buf, pos + size)
+            fences.append((term, offset))
+        self.fp.seek(self.read_pos)
+        return fences
 
-        if not line:
-            return None
+    def close(self):
+        if self.fp:
+            self.fp.close()
 
-        val = ast.literal_eval(line)
-        return val
+    def fill(self, n: int) -> None:
+        """Make sure there are at least n unparsed bytes in the buffer, unless the file ends first."""
+        if len(self.buf) - self.pos >= n or self.fp is None:
+            return
+        size = min(max(self.block_size, n), self.end - self.read_pos)
+        self.buf = self.buf[self.pos :] + self.fp.read(size)
+        self.read_pos += size
+        self.pos = 0
+
+    def value(self):
+        """Decoded posting list of the current token."""
+        return decode_postings(self.payload)
 
     def next(self):
         """Move the buffer to the next (token, value) pair"""
-        token = ""
-
-        char = self.fp.read(1)
-
-        if not char:
+        self.fill(HEADER_SIZE)
+        if self.pos >= len(self.buf):
             self.token = None
             return
+        start = self.pos
+        size, pos = decode_varint(self.buf, self.pos)
+        if len(self.buf) - pos < size + HEADER_SIZE:
+            self.pos = start
+            self.fill(size + HEADER_SIZE + 8)
+            size, pos = decode_varint(self.buf, self.pos)
+            start = self.pos
+        buf = self.buf
+        self.token = buf[pos : pos + size].decode("UTF-8")
+        if self.hi is not None and self.token >= self.hi:
+            self.token = None
+            return
+        pos += size
+        self.df, pos = decode_varint(buf, pos)
+        self.cf, pos = decode_varint(buf, pos)
+        self.last, pos = decode_varint(buf, pos)
+        length, pos = decode_varint(buf, pos)
+        self.pos = pos
+        self.fill(length)
+        self.payload = self.buf[self.pos : self.pos + length]
+        self.pos += length
+        self.records += 1
+        self.bytes += pos - start + length
 
-        token = []
-        while char != ":":
-            token.append(char)
-            char = self.fp.read(1)
-            if char == "\n":
-                self.total = int("".join(token))
-                self.next()
-                return
-
-        self.token = "".join(token)
+    def rate(self) -> Tuple[float, float]:
+        """Records and bytes consumed per second since the buffer was created."""
+        elapsed = (time() - self.start) or 1e-9
+        return self.records / elapsed, self.bytes / elapsed
 
     def __gt__(self, other) -> bool:
         if self.token is None:
@@ -65,3 +197,59 @@ class FileBuffer:
 
     def __hash__(self) -> int:
         return hash(self.id)
+
+
+def read_fences(fdir: str, filename: str) -> List[Tuple[str, int]]:
+    """(term, size in bytes) of each interval between consecutive fences of a run, the term being the
+    first one of the interval."""
+    buf = FileBuffer(fdir, filename)
+    if buf.fp is None or not buf.end:
+        buf.close()
+        return []
+    _, nfences = buf.footer()
+    fences = buf.fences(nfences)
+    buf.close()
+    offsets = [offset for _, offset in fences] + [buf.end]
+    return [(term, offsets[i + 1] - offset) for i, (term, offset) in enumerate(fences)]
+
+
+def merge_rate(f_buf: Iterable[FileBuffer]) -> Dict[str, float]:
+    """Records and MB consumed per second over all buffers, since the oldest one was created."""
+    f_buf = list(f_buf)
+    if not f_buf:
+        return {"records/s": 0.0, "MB/s": 0.0}
+    elapsed = (time() - min(buf.start for buf in f_buf)) or 1e-9
+    return {
+        "records/s": sum(buf.records for buf in f_buf) / elapsed,
+        "MB/s": sum(buf.bytes for buf in f_buf) / elapsed / MEGABYTE,
+    }
+
+
+def merge_buffers(f_buf: Iterable[FileBuffer]) -> Iterator[FileBuffer]:
+    """K-way merge of FileBuffers with a heap. Yields the buffer with the lexicographically smallest
+    token and docid, which is moved to its next (token, value) pair when the iteration resumes, so its
+    value must be read before that. Exhausted buffers are closed. O(log k) per step.
+
+    Args:
+        f_buf (Iterable[FileBuffer]): Buffers to merge, with distinct ids.
+
+    Yields:
+        FileBuffer: The smallest buffer.
+    """
+    # Keyed by (token, id), ids are unique so the buffers themselves are never compared.
+    heap = []
+    for buf in f_buf:
+        if buf.token is None:
+            buf.close()
+        else:
+            heap.append((buf.token, buf.id, buf))
+    heapq.heapify(heap)
+    while heap:
+        _, id, buf = heap[0]
+        yield buf
+        buf.next()
+        if buf.token is None:
+            buf.close()
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (buf.token, id, buf))
@@ -0,0 +1,115 @@
+import os
+from time import monotonic
+from typing import Dict, List, Optional
+
+MEGABYTE = 1024 * 1024
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# Fractions of the budget: above HIGH_WATERMARK workers are retired, new ones are only started while
+# the process tree plus one more worker stays under LOW_WATERMARK.
+HIGH_WATERMARK = 0.9
+LOW_WATERMARK = 0.75
+# Seconds a sample of the process tree's memory is reused for.
+SAMPLE_INTERVAL = 0.5
+# Seconds between two added workers, so the last one's memory is seen before adding the next.
+GROW_INTERVAL = 5.0
+# Smallest in-memory run budget in MB a worker is given, see index.spimi.SpimiInverter.
+MIN_RUN_MEMORY = 4
+
+
+def rss(pid: int) -> int:
+    """Resident set size in bytes of the process pid, from /proc/{pid}/statm, 0 if it is gone."""
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def descendants(pid: int) -> List[int]:
+    """Pids of the children of pid, their children and so on, from the parent pids in /proc/*/stat."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may hold spaces, the parent pid is the second field after it.
+        ppid = int(stat[stat.rindex(b")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    out: List[int] = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            out.append(child)
+            stack.append(child)
+    return out
+
+
+class MemoryGovernor:
+    """Keeps the memory of the whole process tree (the indexer and every worker it started) under a
+    budget, by sampling the RSS of each process from /proc. RLIMIT_AS only bounds each process on its
+    own, and the workers' memory depends on the documents, so the number of workers and their run
+    budgets are adjusted to what is actually used rather than set from estimates.
+
+    The number of workers grows, up to max_workers, while the tree plus the largest worker seen fits
+    under LOW_WATERMARK of the budget, and shrinks while the tree is above HIGH_WATERMARK. The run
+    budget given to new tasks is the free memory under HIGH_WATERMARK split between the workers.
+    """
+
+    def __init__(self, budget: int, max_workers: int, run_memory: int = 32, pid: Optional[int] = None) -> None:
+        """
+        Args:
+            budget (int): Memory budget in MB of the process tree.
+            max_workers (int): Maximum number of workers.
+            run_memory (int, optional): Run budget in MB of a worker when memory is plentiful, it grows to at
+                most 4 times this on big machines. Defaults to 32.
+            pid (int, optional): Root of the process tree. Defaults to this process.
+        """
+        self.budget = budget * MEGABYTE
+        self.max_workers = max(1, max_workers)
+        self.run_memory = run_memory
+        self.pid = pid or os.getpid()
+        self.sampled = -SAMPLE_INTERVAL
+        self.total = 0
+        self.worker_peak = 0
+        self.grown = -GROW_INTERVAL
+
+    def sample(self) -> int:
+        """Total RSS in bytes of the process tree, sampled at most every SAMPLE_INTERVAL seconds."""
+        now = monotonic()
+        if now - self.sampled >= SAMPLE_INTERVAL:
+            children = [rss(pid) for pid in descendants(self.pid)]
+            self.total = rss(self.pid) + sum(children)
+            self.worker_peak = max([self.worker_peak, *children])
+            self.sampled = now
+        return self.total
+
+    def target(self, current: int) -> int:
+        """Number of workers to run, given that current are running."""
+        total = self.sample()
+        if total > HIGH_WATERMARK * self.budget:
+            return max(1, current - 1)
+        now = monotonic()
+        if (
+            current < self.max_workers
+            and now - self.grown >= GROW_INTERVAL
+            and total + self.worker_peak < LOW_WATERMARK * self.budget
+        ):
+            self.grown = now
+            return current + 1
+        # Recycled workers may all have exited, the stream still needs one.
+        return max(1, current)
+
+    def fit(self, worker_memory: int) -> int:
+        """Number of workers, up to max_workers, that fit under HIGH_WATERMARK of the budget along with the
+        process tree, if each uses worker_memory MB. Used as a starting point, before workers are measured."""
+        free = HIGH_WATERMARK * self.budget - self.sample()
+        return max(1, min(self.max_workers, int(free // (worker_memory * MEGABYTE))))
+
+    def run_budget(self, workers: int) -> int:
+        """Run budget in MB for the next task of one of workers workers."""
+        free = (HIGH_WATERMARK * self.budget - self.sample()) / MEGABYTE
+        return int(max(MIN_RUN_MEMORY, min(4 * self.run_memory, free / max(1, workers))))
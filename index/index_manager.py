@@ -1,121 +1,350 @@
 import os
-from queue import Empty
 import re
-from collections import OrderedDict
+from bisect import bisect_left
+from collections import Counter, OrderedDict
 from functools import reduce
 from gc import collect
 from traceback import print_exc
+from typing import Dict, List, Tuple
 
-from charset_normalizer import from_bytes
-from joblib import Parallel, delayed
-from joblib.externals.loky import get_reusable_executor
 from nltk_light import download, word_tokenize
-from nltk_light.stem import RSLPStemmer
 from tqdm import tqdm
 
-from .partial_index import partial_index_cb, merge_counts, merge_indexes
-from .util import count, get_visible, ignored_words, warc_loader, partitioned_loader
+from .charset import decode
+from .checkpoint import Checkpoint, build_config
+from .governor import MemoryGovernor
+from .meta import write_index_meta
+from .partial_index import merge_counts, merge_indexes
+from .pipeline import Pipeline
+from .prefilter import MAX_DOCUMENT_SIZE, MEGABYTE
+from .spimi import SpimiInverter
+from .stemmer import CachedStemmer, Vocabulary
+from .url_store import UrlStore
+from .util import (
+    LETTER_WORD,
+    DocidAllocator,
+    count,
+    fast_tokenize,
+    get_visible,
+    ignored_words,
+    member_records,
+    scan_member,
+    warc_members,
+)
 
-stemmer = RSLPStemmer()
+stemmer = CachedStemmer()
+# Most recently stemmed words of the last worker, each new worker is prewarmed with them.
+VOCABULARY = "cache/vocabulary"
 
 
-def count_worker(document: bytes, idx: int) -> None:
-    """Writes to the file idx a mapping of the tokens in document to their counts.
+def count_worker(
+    document: bytes, content_type: str = None, stats: Counter = None, fast: bool = False
+) -> Tuple[int, OrderedDict]:
+    """Maps the tokens in document to their counts.
 
     Args:
         document (bytes): Document to be processed.
-        idx (int): The document's index.
+        content_type (str, optional): Its Content-Type header, for its charset (see index.charset.decode).
+        stats (Counter, optional): Counts the charset detection paths taken.
+        fast (bool, optional): If the text is tokenized with index.util.fast_tokenize instead of word_tokenize.
+
+    Returns:
+        Tuple[int, OrderedDict]: The number of tokens in the document and the mapping.
     """
-    vis = get_visible(str(from_bytes(document).best())) # O(len(document))
-    tokens = word_tokenize(vis, "portuguese") # O(len(document))
-    ntokens = len(tokens)
-    tokens = filter(lambda word: not re.search(r"[^\w]|[\d]|\_", word), tokens) # O(len(document))
-    tokens = filter(lambda word: word not in ignored_words, tokens) # O(len(document))
+    vis = get_visible(decode(document, content_type, stats)) # O(len(document))
+    if fast:
+        ntokens, tokens = fast_tokenize(vis) # O(len(document))
+    else:
+        tokens = word_tokenize(vis, "portuguese") # O(len(document))
+        ntokens = len(tokens)
+        tokens = filter(lambda word: not re.search(r"[^\w]|[\d]|\_", word), tokens) # O(len(document))
+        tokens = filter(lambda word: word not in ignored_words, tokens) # O(len(document))
     tokens = map(stemmer.stem, tokens) # O(len(document))
     tokens = sorted(tokens) # O(len(tokens)log len(tokens)), in the worst case len(tokens) = len(document) <- dominating
-    tokens = reduce(count, tokens, OrderedDict()) # O(len(document))
-
-    with open(f"cache/pre_ind/{idx}", "w", encoding="UTF-8") as f:
-        f.write(f"{ntokens}\n")
-        for token, c in tokens.items():
-            f.write(f"{token}: {c}\n")
+    return ntokens, reduce(count, tokens, OrderedDict()) # O(len(document))
 
 
-def count_worker_plain(document: bytes, idx: int) -> None:
-    """Writes to the file idx a mapping of the tokens in document to their counts. Plaintext version.
+def count_worker_plain(
+    document: bytes, content_type: str = None, stats: Counter = None, fast: bool = False
+) -> Tuple[int, OrderedDict]:
+    """Maps the tokens in document to their counts. Plaintext version.
 
     Args:
         document (bytes): Document to be processed.
-        idx (int): The document's index.
+        content_type (str, optional): Its Content-Type header, for its charset (see index.charset.decode).
+        stats (Counter, optional): Counts the charset detection paths taken.
+        fast (bool, optional): If the text is tokenized with index.util.fast_tokenize instead of word_tokenize,
+            which removes the stopwords before stemming.
+
+    Returns:
+        Tuple[int, OrderedDict]: The number of tokens in the document and the mapping.
     """
-    tokens = word_tokenize(str(from_bytes(document).best()), "portuguese")
-    ntokens = len(tokens)
-    tokens = filter(lambda word: not re.search(r"[^\w]|[\d]|\_", word), tokens)
-    tokens = map(stemmer.stem, tokens)
-    tokens = filter(lambda word: word not in ignored_words, tokens)
+    text = decode(document, content_type, stats)
+    if fast:
+        ntokens, tokens = fast_tokenize(text)
+        tokens = map(stemmer.stem, tokens)
+    else:
+        tokens = word_tokenize(text, "portuguese")
+        ntokens = len(tokens)
+        tokens = filter(lambda word: not re.search(r"[^\w]|[\d]|\_", word), tokens)
+        tokens = map(stemmer.stem, tokens)
+        tokens = filter(lambda word: word not in ignored_words, tokens)
     tokens = sorted(tokens)
-    tokens = reduce(count, tokens, OrderedDict())
+    return ntokens, reduce(count, tokens, OrderedDict())
+
+
+def analyzer_config(plaintext: bool, max_document_size: int = MAX_DOCUMENT_SIZE, tokenizer: str = "nltk") -> Dict:
+    """Description of the pipeline count_worker (or count_worker_plain) applies to documents, written
+    to the index metadata. Queries have to be analyzed the same way (the query processor follows "tokenizer")."""
+    fast = tokenizer == "fast"
+    return {
+        "filter": "extension,record-type,status,content-type,magic",
+        "max_document_size": max_document_size,
+        "charset": "content-type,meta,utf-8,charset_normalizer",
+        "visible_text": not plaintext,
+        "tokenizer": "fast" if fast else "word_tokenize(portuguese)",
+        "token_filter": LETTER_WORD.pattern if fast else r"[^\w]|[\d]|\_",
+        "lowercase": fast,
+        "stopwords": "nltk portuguese",
+        "stemmer": "rslp",
+        # count_worker_plain removes stopwords after stemming, unless the tokenizer removes them.
+        "stem_before_stopwords": plaintext and not fast,
+    }
+
+
+def create_count(
+    member: Tuple[str, int, int, List[int], Dict[int, int]],
+    documents_path: str,
+    plaintext=False,
+    max_document_size=MAX_DOCUMENT_SIZE,
+    tokenizer="nltk",
+) -> Tuple[int, int, List[str], Counter, List[Tuple[str, int]]]:
+    """Decodes a warc file and inverts its documents, in docid order, with a SpimiInverter, writing runs to
+    cache/runs and the documents' term counts to cache/partial_counts. The stemmer's cache is prewarmed from
+    VOCABULARY, and its most frequent words are returned, to be saved there. Documents are filtered by their headers
+    and magic bytes (see index.util.member_records) and truncated to max_document_size MB before they are decoded,
+    so a large binary or page never has to fit in memory. O(len(documents) * n log n)
 
-    with open(f"cache/pre_ind/{idx}", "w", encoding="UTF-8") as f:
-        f.write(f"{ntokens}\n")
-        for token, c in tokens.items():
-            f.write(f"{token}: {c}\n")
+    Args:
+        member (Tuple[str, int, int, List[int], Dict[int, int]]): Name of the warc file in the zip file, the index of
+            its first document, the memory budget in MB of the in-memory inverted index, the positions of its
+            duplicate documents, which are skipped, and the number of duplicates of its documents that have some
+            (see index.util.DocidAllocator), which are counted as postings saved.
+        documents_path (str): Path to the zip file containing the warc files.
+        plaintext (bool, optional): If the documents are plaintext. Defaults to False.
+        max_document_size (int, optional): Size in MB documents are truncated to. Defaults to MAX_DOCUMENT_SIZE.
+        tokenizer (str, optional): One of index.util.TOKENIZER_CHOICES. Defaults to "nltk".
+
+    Returns:
+        Tuple[int, int, List[str], Counter, List[Tuple[str, int]]]: The warc file's docid range [lo, hi), the
+            names of the runs written, counters of how its documents were processed and the words stemmed the
+            most, with their counts (see index.stemmer.Vocabulary).
+    """
+    name, idx, run_memory, skipped, duplicates = member
+    start = idx
+    skip = set(skipped)
+    stats: Counter = Counter()
+    countf = count_worker if not plaintext else count_worker_plain
+    fast = tokenizer == "fast"
+    stemmer.load(VOCABULARY)
+    hits, misses = stemmer.hits, stemmer.misses
+    inverter = SpimiInverter("cache/runs", "cache/partial_counts", run_memory)
+    for position, (_, record, payload) in enumerate(member_records(documents_path, name, stats)):
+        if position in skip:
+            continue
+        headers = record.http_headers or record.rec_headers
+        try:
+            document = payload.read(max_document_size * MEGABYTE, stats)
+            ntokens, counts = countf(document, headers.get_header("Content-Type"), stats, fast)
+        except Exception as e:
+            print(e)
+            print_exc()
+            idx += 1
+            continue
+        inverter.add(idx, ntokens, counts)
+        stats["postings.indexed"] += len(counts)
+        if idx in duplicates:
+            stats["postings.duplicate"] += len(counts) * duplicates[idx]
+        idx += 1
+    inverter.flush()
+    stats["stemmer.hits"] += stemmer.hits - hits
+    stats["stemmer.misses"] += stemmer.misses - misses
+    return start, idx, inverter.names, stats, stemmer.frequent()
 
 
-def create_count(document: bytes, idx: int) -> None:
-    """Calls index_worker(/2) and collects garbage after its execution. O(1)"""
-    try:
-        count_worker(document, idx)
-    except Exception as e:
-        print(e)
-        print_exc()
-    # collect()
+def print_stats(stats: Counter) -> None:
+    """Print the counters of the counting phase, grouped by their prefix ("charset.header" is in "charset")."""
+    groups: Dict[str, List[Tuple[str, int]]] = {}
+    for key, value in sorted(stats.items()):
+        group, _, name = key.partition(".")
+        groups.setdefault(group, []).append((name, value))
+    for group, values in groups.items():
+        total = sum(value for _, value in values) or 1
+        print(f"{group}: " + ", ".join(f"{name} {value} ({100 * value / total:.1f}%)" for name, value in values))
 
 
-def index_manager(corpus_path: str, max_memory: int, ndocs=None, plaintext=False) -> None:
-    """Manages the index creation process. First it creates the token -> count files for
-    each document in the corpus (located in the documents_path). Then it creates partial
-    indexes by merging said counts in sets of a 1000. Finally it merges the partial indexes.
+def index_manager(
+    corpus_path: str,
+    max_memory: int,
+    ndocs=None,
+    plaintext=False,
+    run_memory=32,
+    codec="vbyte",
+    impacts=False,
+    out="final",
+    base=0,
+    resume=False,
+    max_document_size=MAX_DOCUMENT_SIZE,
+    dedup="off",
+    near=False,
+    tokenizer="nltk",
+) -> None:
+    """Manages the index creation process. First the warc files of the corpus (located in the documents_path)
+    are scanned in parallel for their urls, which gives each one its docid range. Then it inverts the documents
+    one warc file per worker, each worker decoding its warc file itself and accumulating the postings in memory,
+    writing them as sorted runs once its memory budget is reached (SPIMI). Finally it merges the runs.
     It does that without surpassing the memory limit provided by max_memory.
 
-    It adapts to how much memory is available by assuming that a process running the create_count
-    function won't exceed 250MB and a process merging the counts won't exceed 100MB. Therefore we can create
-    $max_memory//count_mem$ and $max_memory//partial_mem$ processes for each step. Since it wouldn't make
-    sense to create too many more processes than twice the ammount of cpu cores, we limit the process count
-    to that ammount.
+    It adapts to how much memory is available with a MemoryGovernor, that samples the memory used by this
+    process and every worker from /proc. It starts as many workers as fit in the memory left, assuming that a
+    process running the create_count function won't exceed 150MB plus the run_memory budget, up to the number
+    of cpu cores, then adds or retires workers and sizes their in-memory runs from what they actually use.
 
-    Since the final merging step opens as many file pointers as there are partial indexes,
-    it could exceed max_memory or the max open files limit, this could be fixed by merging
-    the partial indexes until there were less than a set amount of partial indexes. Even
-    then it could still exceed the memory limit if the lines of the partial indexes were too big.
-    This won't happen for less than 10**6 documents.
+    Since a merge opens one file pointer (and buffer) per run, the runs are merged in passes of at
+    most fan-in runs, derived from the open files limit and max_memory, until the final merge can be
+    done in a single pass. It could still exceed the memory limit if a single posting list was too big.
+    The document lengths are written to {out}/lengths and the collection statistics, analyzer and codec
+    to {out}/meta before the final merge, which needs them for the block maximum scores.
+    The final merge is split by term range between as many processes as fit in the memory left (assuming a
+    merging process won't exceed 100MB), each writing a shard of the index.
 
     Args:
         documents_path (str): Path to the document corpus.
         max_memory (int): Max memory in MB that the indexer can use at any given moment.
         ndocs (int|optional): Number of documents in the corpus.
         plaintext(bool|optional): If the corpus contains only plaintext files. Set to False by default.
+        run_memory(int|optional): Memory budget in MB of each worker's in-memory inverted index when memory is
+            plentiful, see index.governor.MemoryGovernor.run_budget. Set to 32 by default.
+        codec(str|optional): Codec of the final posting lists, one of index.codecs.CODEC_CHOICES. Set to "vbyte" by
+            default.
+        impacts(bool|optional): If the quantized BM25 and TF-IDF scores of each posting are stored in the index
+            (see index.blocks.Impacts), so queries only add them up. Set to False by default.
+        out(str|optional): Directory to write the index to. Set to "final" by default.
+        base(int|optional): Docid of the first document, for segments (see index.segments). Set to 0 by default.
+        resume(bool|optional): If the build continues from the checkpoint in cache/progress, left by a build of
+            the same corpus that did not finish (see index.checkpoint.Checkpoint). Set to False by default.
+        max_document_size(int|optional): Size in MB documents are truncated to, see index.prefilter.Payload.
+            Set to MAX_DOCUMENT_SIZE (8) by default.
+        dedup(str|optional): What is done with the documents that duplicate another one, one of
+            index.dedup.DEDUP_MODES. Set to "off" by default.
+        near(bool|optional): If documents with almost the same text are duplicates too, not only byte-identical ones
+            (see index.dedup.near_signature). Set to False by default.
+        tokenizer(str|optional): Tokenizer of the analyzer, one of index.util.TOKENIZER_CHOICES, "fast" is
+            index.util.fast_tokenize. Set to "nltk" (word_tokenize) by default.
     """
     download("rslp")
 
     cpu_count = os.cpu_count() or 4
-    count_mem = 150 if not plaintext else 120
-    count_jobs = min(((max_memory // count_mem) - 1, cpu_count))
-    partial_mem = 100
-    partial_jobs = min(((max_memory // partial_mem) - 1, cpu_count))
-    loader = warc_loader(corpus_path, total=ndocs)
-    countf = create_count if not plaintext else count_worker_plain
+    governor = MemoryGovernor(max_memory, cpu_count, run_memory)
+    count_mem = (150 if not plaintext else 120) + run_memory
+    merge_mem = 100
+    config = build_config(corpus_path, out, base, plaintext, dedup, near, tokenizer)
+    checkpoint = Checkpoint.open("cache", config, resume)
+    if checkpoint.phase == "done":
+        return
+    stats: Counter = Counter()
+    if checkpoint.phase == "count":
+        stats = count_terms(
+            corpus_path,
+            ndocs,
+            plaintext,
+            governor,
+            governor.fit(count_mem),
+            out,
+            base,
+            checkpoint,
+            max_document_size,
+            dedup,
+            near,
+            tokenizer,
+        )
+
+    print("MERGING RUNS:")
+    ndocs, ntokens = merge_counts(out, base)
+    urls = UrlStore(os.path.join(out, "urls"))
+    end = base + len(urls)
+    urls.close()
+    analyzer = analyzer_config(plaintext, max_document_size, tokenizer)
+    quantization = write_index_meta(out, ndocs, ntokens, base, end, analyzer, codec, impacts)
+    collect()
+    merge_indexes(
+        "cache/runs",
+        max_memory=max_memory,
+        jobs=governor.fit(merge_mem),
+        codec=codec,
+        impacts=quantization,
+        out=out,
+        checkpoint=checkpoint,
+    )  # O(npostings*log(nfiles))
+    checkpoint.phase = "done"
+    if stats["postings.duplicate"]:
+        print_savings(out, stats)
+    collect()
+
+
+def print_savings(out: str, stats: Counter) -> None:
+    """Print the estimated size of the postings of the duplicate documents that were not indexed, at the index's
+    bytes per posting."""
+    size = sum(os.path.getsize(os.path.join(out, name)) for name in os.listdir(out) if name.split(".")[0] == "index")
+    saved = size * stats["postings.duplicate"] / (stats["postings.indexed"] or 1)
+    print(
+        f"Deduplication saved {stats['postings.duplicate']} postings, about {saved / MEGABYTE:.2f}MB"
+        f" ({100 * saved / ((size + saved) or 1):.1f}% of the index)"
+    )
+
+
+def count_terms(
+    corpus_path: str,
+    ndocs: int,
+    plaintext: bool,
+    governor: MemoryGovernor,
+    count_jobs: int,
+    out: str,
+    base: int,
+    checkpoint: Checkpoint,
+    max_document_size: int = MAX_DOCUMENT_SIZE,
+    dedup: str = "off",
+    near: bool = False,
+    tokenizer: str = "nltk",
+) -> Counter:
+    """Counting phase of index_manager(/4). The warc files are first scanned by worker processes, the main
+    process only gives them docid ranges and writes the urls (see index.util.DocidAllocator). Then the warc
+    files are streamed to worker processes (see index.pipeline.Pipeline) that decode and invert them into
+    runs, each warc file is recorded as counted in the checkpoint as soon as it is done. Both start with
+    count_jobs workers, then the governor sets their number. Both stages skip the same documents (see
+    index.util.member_records), the counters of the documents skipped are printed at the end, and returned.
+    Duplicate documents are found as the scanned warc files are given docids, counting skips them."""
+    members = warc_members(corpus_path)
+    allocator = DocidAllocator(members, out, base, checkpoint, total=ndocs, dedup=dedup, near=near)
+    allocator.advance()
+    signatures = None if dedup == "off" else "near" if near else "exact"
+    scan_args = (corpus_path, signatures, plaintext, max_document_size)
+    Pipeline(scan_member, scan_args, count_jobs, allocator.add, governor=governor).run(
+        member for member in members if not checkpoint.is_scanned(member)
+    )
+    allocator.close()
+    checkpoint.save()
 
     print("COUNTING TERMS:")
 
     """
     Python refuses to completely free allocated memory (https://rushter.com/blog/python-garbage-collector/)
     even when calling gc.collect(/0), it does however reuse it. For the 10**6 documents provided this does
-    not pose a problem. However for larger values, or different collections of documents it may. The following
-    code kills the processes after 10000 documents (1 WARC file), and restarts them to process the next 10000 documents.
-    The memory usage of the main process still increases nevertheless, because python just does that, but this
-    could be mitigated by doing something similar with index_manager(/4), where an alternate version of this
-    function runs in a separate process that restarts after some time.
+    not pose a problem. However for larger values, or different collections of documents it may. So each
+    counting process exits after 1 WARC file (10000 documents), and is replaced by a new one, while the others
+    keep working. The memory usage of the main process still increases nevertheless, because python just does
+    that, but this could be mitigated by doing something similar with index_manager(/4), where an alternate
+    version of this function runs in a separate process that restarts after some time.
 
     \"If you create a large object and delete it again, Python has probably released the memory, but the
     memory allocators involved don’t necessarily return the memory to the operating system\"
@@ -126,38 +355,43 @@ def index_manager(corpus_path: str, max_memory: int, ndocs=None, plaintext=False
     which does the memory-hungry work then terminates.\"
     https://stackoverflow.com/questions/1316767/how-can-i-explicitly-free-memory-in-python/1316799#1316799
 
-    If done without restarting the processes count_meme has to be set to 250 if not plaintext else 150, and create_count
-    should call collect(/0).
+    If done without restarting the processes count_mem has to be set to 250 if not plaintext else 150.
     """
-    while True:
-        try:
-            Parallel(n_jobs=count_jobs)(
-                delayed(countf)(doc, idx) for doc, idx in partitioned_loader(loader, 10000) # O((n log n)*|Corpus|)
-            )
-        except (RuntimeError, StopIteration, Empty):
-            # partitioned loader throws StopIteration, but this exception is caught by Parallel and it throws RuntimeError.
-            print("Finished Count")
-            break
-
-
-        get_reusable_executor().shutdown(wait=True)
-        collect()
-    get_reusable_executor().shutdown(wait=True)
-    collect()
+    pbar = tqdm(total=allocator.idx - base, desc="Counting")
 
-    with Parallel(n_jobs=partial_jobs) as parallel:
-        num_counts = len(os.listdir("cache/pre_ind"))
-        step = 1000
-        print("CREATING PARTIAL INDEXES:")
-        parallel(
-            delayed(partial_index_cb)("cache/pre_ind", start, start + step) # O(n*nfiles) n = docsize
-            for start in tqdm(range(0, num_counts, step))
-        )
+    stats: Counter = allocator.dedup.stats if allocator.dedup else Counter()
+    duplicates = sorted(allocator.duplicates.items())
 
-    get_reusable_executor().shutdown(wait=True)
-    collect()
-    print("MERGING PARTIAL INDEXES:")
-    merge_counts()
-    collect()
-    merge_indexes("cache/partial_indexes")# O(nterms*nfiles)
+    def member_duplicates(start: int, end: int) -> Dict[int, int]:
+        return dict(duplicates[bisect_left(duplicates, (start,)) : bisect_left(duplicates, (end,))])
+
+    vocabulary = Vocabulary(VOCABULARY)
+
+    def counted(result: Tuple[int, int, List[str], Counter, List[Tuple[str, int]]]) -> None:
+        checkpoint.add_counted([result[:3]])
+        stats.update(result[3])
+        vocabulary.add(result[4])
+        vocabulary.save()
+        pbar.update(result[1] - result[0])
+
+    # Only 2 warc files per worker wait in the queue, the reader blocks until a worker takes one. Each worker
+    # counts a single warc file, so workers are retired simply by not replacing them.
+    count_args = (corpus_path, plaintext, max_document_size, tokenizer)
+    pipeline = Pipeline(create_count, count_args, count_jobs, counted, max_tasks=1, governor=governor)
+    pipeline.run(
+        (
+            member,
+            start,
+            governor.run_budget(len(pipeline.workers)),
+            allocator.skipped[member],
+            member_duplicates(start, end),
+        )
+        for member, (start, end) in allocator.ranges.items()
+        if not checkpoint.is_counted(start, end)
+    ) # O((n log n)*|Corpus|)
+    pbar.close()
+    print("Finished Count")
+    print_stats(stats)
     collect()
+    checkpoint.finish_count()
+    return stats
@@ -0,0 +1,115 @@
+import struct
+from array import array
+from typing import Iterator, NamedTuple, Optional
+
+from .mapped import MappedFile
+from .postings import decode_varint, encode_varint
+
+# Footer: number of terms, offset of the record offsets table, magic.
+FOOTER = struct.Struct("<QQ4s")
+MAGIC = b"LEX1"
+
+
+class LexiconEntry(NamedTuple):
+    term: str
+    offset: int  # Offset in bytes of the posting list in the index.
+    length: int  # Length in bytes of the posting list.
+    df: int  # Number of documents containing the term.
+    cf: int  # Number of occurrences of the term in the collection.
+
+
+class LexiconWriter:
+    """Writes the lexicon of an index. Terms must be added in sorted order.
+
+    The file holds one varint encoded record per term (term length, term, offset, length, df, cf),
+    followed by a table with the offset of each record and a fixed size footer, so that it can be
+    opened without reading the records, and searched by bisection.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.fp = open(path, "wb")
+        self.starts = array("Q")
+        self.pos = 0
+
+    def add(self, term: str, offset: int, length: int, df: int, cf: int) -> None:
+        encoded = term.encode("UTF-8")
+        record = bytearray()
+        encode_varint(len(encoded), record)
+        record += encoded
+        for value in (offset, length, df, cf):
+            encode_varint(value, record)
+        self.starts.append(self.pos)
+        self.fp.write(record)
+        self.pos += len(record)
+
+    def close(self) -> None:
+        self.starts.tofile(self.fp)
+        self.fp.write(FOOTER.pack(len(self.starts), self.pos, MAGIC))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class Lexicon:
+    """Read only view of a lexicon written by LexiconWriter. The file is memory mapped, opening it
+    reads only the footer, and each lookup decodes O(log nterms) records."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = MappedFile(path)
+        n, self.table_offset, magic = FOOTER.unpack(self.file.read(len(self.file) - FOOTER.size, FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a lexicon")
+        self.starts = self.file.read(self.table_offset, n * 8).cast("Q")
+
+    def close(self) -> None:
+        self.starts.release()
+        self.file.close()
+
+    def record(self, i: int) -> LexiconEntry:
+        """Decode the i'th record of the lexicon."""
+        start = self.starts[i]
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else self.table_offset
+        buf = self.file.read(start, end - start)
+        size, pos = decode_varint(buf, 0)
+        term = str(buf[pos : pos + size], "UTF-8")
+        pos += size
+        values = []
+        for _ in range(4):
+            value, pos = decode_varint(buf, pos)
+            values.append(value)
+        return LexiconEntry(term, *values)
+
+    def get(self, term: str) -> Optional[LexiconEntry]:
+        """Binary search for term. O(log nterms)"""
+        lo, hi = 0, len(self.starts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self.record(mid)
+            if entry.term < term:
+                lo = mid + 1
+            elif entry.term > term:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def __contains__(self, term: str) -> bool:
+        return self.get(term) is not None
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __iter__(self) -> Iterator[LexiconEntry]:
+        for i in range(len(self.starts)):
+            yield self.record(i)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
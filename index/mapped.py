@@ -0,0 +1,75 @@
+import mmap
+import os
+from collections import OrderedDict
+from threading import Lock
+
+MEGABYTE = 1024 * 1024
+
+
+class MappedFile:
+    """Read only, memory mapped view of a file with positional reads that return memoryviews into the
+    mapping, so there is no shared file cursor and no copy. Processes mapping the same file share the
+    page cache.
+
+    Files up to window bytes are mapped whole. Larger files are mapped in windows of window bytes, of
+    which at most max_windows are kept, so the address space used stays bounded (RLIMIT_AS counts
+    mappings, not only resident memory). Reads larger than a window get a mapping of their own.
+
+    Mappings are not pickled, they are recreated lazily, so instances can be sent to worker processes.
+    """
+
+    def __init__(self, path: str, window: int = 64 * MEGABYTE, max_windows: int = 4) -> None:
+        self.path = path
+        self.window = max(window - window % mmap.ALLOCATIONGRANULARITY, mmap.ALLOCATIONGRANULARITY)
+        self.max_windows = max_windows
+        self.size = os.path.getsize(path)
+        self.whole = None
+        self.windows = OrderedDict()
+        self.lock = Lock()
+
+    def map(self, start: int, length: int) -> mmap.mmap:
+        with open(self.path, "rb") as f:
+            return mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=start)
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """Read length bytes starting at offset. O(1)"""
+        if length <= 0:
+            return memoryview(b"")
+        if self.size <= self.window:
+            if self.whole is None:
+                with self.lock:
+                    if self.whole is None:
+                        self.whole = memoryview(self.map(0, self.size))
+            return self.whole[offset : offset + length]
+
+        start = offset - offset % self.window
+        if offset + length > start + self.window:
+            # Spans more than one window, map exactly the pages it covers.
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            end = min(offset + length, self.size)
+            return memoryview(self.map(start, end - start))[offset - start : end - start]
+
+        with self.lock:
+            view = self.windows.get(start)
+            if view is None:
+                view = memoryview(self.map(start, min(self.window, self.size - start)))
+                self.windows[start] = view
+                if len(self.windows) > self.max_windows:
+                    # Evicted mappings are unmapped once the views returned from them are released.
+                    self.windows.popitem(last=False)
+            else:
+                self.windows.move_to_end(start)
+        return view[offset - start : offset - start + length]
+
+    def close(self) -> None:
+        self.whole = None
+        self.windows.clear()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getstate__(self):
+        return {"path": self.path, "window": self.window, "max_windows": self.max_windows}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["window"], state["max_windows"])
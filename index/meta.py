@@ -0,0 +1,130 @@
+import json
+from array import array
+import os
+from typing import Dict, Iterable, Optional, Tuple
+
+from .blocks import BLOCK_SIZE, BM25_B, BM25_K1, Impacts
+from .mapped import MappedFile
+
+# Document lengths are stored as native unsigned 32 bit ints, indexed by docid.
+LENGTH_TYPECODE = "I"
+
+
+def write_lengths(path: str, lengths: Iterable[Tuple[int, int]], base: int = 0) -> Tuple[int, int]:
+    """Write the document lengths to path as an array indexed by docid - base, with 0 for missing
+    docids. O(ndocs)
+
+    Args:
+        path (str): Path to write the lengths to.
+        lengths (Iterable[Tuple[int, int]]): (docid, length) pairs, in any order.
+        base (int, optional): First docid of the index. Defaults to 0.
+
+    Returns:
+        Tuple[int, int]: Number of documents and total number of tokens.
+    """
+    out = array(LENGTH_TYPECODE)
+    ndocs = total = 0
+    for docid, length in lengths:
+        docid -= base
+        if docid >= len(out):
+            out.extend(bytes(docid + 1 - len(out)))
+        out[docid] = length
+        ndocs += 1
+        total += length
+    with open(path, "wb") as f:
+        out.tofile(f)
+    return ndocs, total
+
+
+def load_lengths(path: str) -> array:
+    """Load the document lengths written by write_lengths(/3), indexed by docid - base. O(ndocs)"""
+    lengths = array(LENGTH_TYPECODE)
+    with open(path, "rb") as f:
+        lengths.frombytes(f.read())
+    return lengths
+
+
+class Lengths:
+    """Read only view of the document lengths written by write_lengths(/3), indexed by docid. The file
+    is memory mapped, so processes reading the same lengths share the page cache. Picklable."""
+
+    def __init__(self, path: str, base: int = 0) -> None:
+        self.path = path
+        self.base = base
+        self.file = MappedFile(path)
+        self.values = self.file.read(0, len(self.file)).cast(LENGTH_TYPECODE)
+
+    def close(self) -> None:
+        self.values.release()
+        self.file.close()
+
+    def __getitem__(self, docid: int) -> int:
+        # O(1)
+        return self.values[docid - self.base]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getstate__(self):
+        return {"path": self.path, "base": self.base}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["base"])
+
+
+def write_meta(path: str, **meta) -> None:
+    """Write the index metadata (number of documents, average document length, analyzer, codec...)
+    to path as JSON."""
+    with open(path, "w", encoding="UTF-8") as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_meta(path: str) -> Dict:
+    with open(path, "r", encoding="UTF-8") as f:
+        return json.load(f)
+
+
+def write_index_meta(
+    out: str,
+    ndocs: int,
+    ntokens: int,
+    base: int,
+    end: int,
+    analyzer: Dict,
+    codec: str,
+    impacts: bool,
+) -> Optional[Impacts]:
+    """Write the metadata of the index in out, whose document lengths are already in {out}/lengths.
+
+    Args:
+        out (str): Directory of the index.
+        ndocs (int): Number of documents.
+        ntokens (int): Total number of tokens.
+        base (int): First docid of the index.
+        end (int): Docid after the last one of the index.
+        analyzer (Dict): Configuration of the analyzer, see index.index_manager.analyzer_config.
+        codec (str): Codec of the posting lists.
+        impacts (bool): If impacts are stored per posting.
+
+    Returns:
+        Optional[Impacts]: The quantization of the impacts, if they are stored.
+    """
+    avgdl = ntokens / (ndocs or 1)
+    quantization = None
+    if impacts:
+        min_length = min(filter(None, load_lengths(os.path.join(out, "lengths"))), default=1)
+        quantization = Impacts.for_collection(ndocs, avgdl, min_length)
+    write_meta(
+        os.path.join(out, "meta"),
+        N=ndocs,
+        avgdl=avgdl,
+        total_tokens=ntokens,
+        base=base,
+        end=end,
+        analyzer=analyzer,
+        codec=codec,
+        block_size=BLOCK_SIZE,
+        bm25={"k1": BM25_K1, "b": BM25_B},
+        impacts=quantization._asdict() if quantization else None,
+    )
+    return quantization
@@ -1,98 +1,331 @@
+import json
 import os
-import shutil
+import resource
 from gc import collect
+from io import BytesIO
+from typing import Iterator, List, Optional, Sequence, Tuple
 
+from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from .file_buffer import FileBuffer
+from .blocks import Impacts, encode_blocks
+from .checkpoint import Checkpoint
+from .file_buffer import MEGABYTE, FileBuffer, RunWriter, merge_buffers, merge_rate, read_fences
+from .lexicon import LexiconWriter
+from .meta import load_lengths, load_meta, write_lengths
+from .postings import decode_varint, encode_varint, split_postings
 
 
-def create_partial_index(count_path: str, start_f: int, end_f: int) -> None:
-    """Create partial indexes from the count mappings in count_path from start_f to end_f.
-    Also create the partial total term counts for the processed documents.
+# File descriptors kept free for the interpreter, the output files and the libraries during a merge.
+RESERVED_FILES = 32
+# Block size of the FileBuffers used when merging.
+MERGE_BLOCK = 256 * 1024
+
+
+def merge_fan_in(max_memory: int, block_size: int = MERGE_BLOCK) -> int:
+    """Number of runs that can be merged at once without exceeding the open files limit
+    (RLIMIT_NOFILE) or half of max_memory, assuming each FileBuffer holds up to three blocks
+    (its block, the unparsed rest of the previous one and the current posting list).
 
     Args:
-        count_path (str): Path where the count mappings are located.
-        start_f (int): File to start from.
-        end_f (int): File to end on.
+        max_memory (int): Memory budget in MB.
+        block_size (int, optional): Block size of the FileBuffers. Defaults to MERGE_BLOCK.
+
+    Returns:
+        int: The fan-in, at least 2.
     """
-    if start_f == end_f:
-        return
-    f_buf = {FileBuffer(count_path, f"{fileidx}") for fileidx in range(start_f, end_f)}
-    f_buf = {f for f in f_buf if f.token is not None}
-    collect()
-
-    with open(f"cache/partial_counts/{start_f}_{end_f}", "w", encoding="UTF-8") as f:
-        for buf in f_buf:
-            if not hasattr(buf, "total"):
-                print()
-            f.write(f"{buf.id}: {buf.total}\n")
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    by_files = soft - RESERVED_FILES if soft != resource.RLIM_INFINITY else 2**16
+    by_memory = (max_memory // 2) * MEGABYTE // (3 * block_size)
+    return max(2, min(by_files, by_memory))
 
-    last = ""
-    with open(f"cache/partial_indexes/{start_f}_{end_f}", "w", encoding="UTF-8") as out:
-        while f_buf:
-            # Of all FileBuffers, get the one with the lexicographically smallest token and docid.
-            m = min(f_buf)
+
+def splice(m: FileBuffer, last_docid: int, out) -> None:
+    """Write the posting list of m to out, after postings that end on last_docid.
+
+    Runs hold disjoint docid ranges, so only the first gap of the run's posting list has
+    to be reencoded, relative to the last docid written.
+    """
+    first, pos = decode_varint(m.payload, 0)
+    gap = bytearray()
+    encode_varint(first - last_docid, gap)
+    out.write(gap)
+    out.write(memoryview(m.payload)[pos:])
+
+
+def merge_runs(partial_path: str, names: List[str], checkpoint: Optional[Checkpoint] = None) -> str:
+    """Merge the runs names, which must hold consecutive docid ranges, into a single run in
+    partial_path, and delete them. O(npostings log len(names))
+
+    Args:
+        partial_path (str): Path containing the runs.
+        names (List[str]): Names of the runs, sorted by docid.
+        checkpoint (Checkpoint, optional): Progress of the build, records the merge before the runs are deleted.
+
+    Returns:
+        str: Name of the merged run.
+    """
+    name = f"{names[0].split('_')[0]}_{names[-1].split('_')[1]}"
+    tmp = os.path.join(partial_path, name + ".tmp")
+    f_buf = [FileBuffer(partial_path, filename, MERGE_BLOCK) for filename in names]
+    last = None
+    last_docid = 0
+    df = cf = 0
+    payload = BytesIO()
+    with RunWriter(tmp) as out:
+        for m in merge_buffers(f_buf):
             if m.token != last:
-                if last:
-                    out.write("]\n")
+                if last is not None:
+                    out.add_encoded(last, df, cf, last_docid, payload.getbuffer())
+                    payload = BytesIO()
                 last = m.token
-                out.write(f"{m.token}: [")
+                last_docid = df = cf = 0
+            splice(m, last_docid, payload)
+            last_docid = m.last
+            df += m.df
+            cf += m.cf
+        if last is not None:
+            out.add_encoded(last, df, cf, last_docid, payload.getbuffer())
+
+    os.rename(tmp, os.path.join(partial_path, name))
+    if checkpoint:
+        checkpoint.merged_runs(names, name)
+    for filename in names:
+        os.remove(os.path.join(partial_path, filename))
+    return name
 
-            out.write(f"({m.id}, {m.value()}),")
-            m.next()
-            if m.token is None:
-                m.close()
-                f_buf.remove(m)
-        out.write("]")
 
+def merge_passes(partial_path: str, fan_in: int, checkpoint: Optional[Checkpoint] = None) -> List[str]:
+    """Merge groups of fan_in consecutive runs into intermediate runs until at most fan_in runs are
+    left, so the final merge can be done in a single pass. Each pass only merges as many groups as
+    needed. O(npostings * log_{fan_in}(nruns))
 
-def partial_index_cb(count_path: str, start_f: int, end_f: int):
-    """Callback to collect garbage after the partial index is created. Probably not necessary."""
-    create_partial_index(count_path, start_f, end_f)
-    collect()
+    Every merge is recorded in the checkpoint, if given, so a resumed build continues from the runs
+    left by the last one.
 
+    Args:
+        partial_path (str): Path containing the runs.
+        fan_in (int): Maximum number of runs open at once.
+        checkpoint (Checkpoint, optional): Progress of the build. Defaults to None.
+
+    Returns:
+        List[str]: Names of the remaining runs.
+    """
+    names = sorted(os.listdir(partial_path), key=lambda name: int(name.split("_")[0]))
+    npass = 0
+    while len(names) > fan_in:
+        npass += 1
+        merged = []
+        i = 0
+        with tqdm(desc=f"Merge pass {npass}") as pbar:
+            while i < len(names):
+                if len(merged) + len(names) - i <= fan_in:
+                    merged.extend(names[i:])
+                    break
+                group = names[i : i + fan_in]
+                merged.append(merge_runs(partial_path, group, checkpoint) if len(group) > 1 else group[0])
+                i += fan_in
+                pbar.update(1)
+                collect()
+        names = merged
+        if checkpoint:
+            checkpoint.finished_pass()
+    return names
 
-def merge_indexes(partial_path):
-    """Merge partial indexes in partial_path, also create a word mapping
-    the word to the line it occurs on the final index.
+
+def split_points(partial_path: str, names: List[str], nparts: int) -> List[str]:
+    """Sample the fences of the runs to find up to nparts - 1 terms that split them into term ranges
+    holding about the same number of bytes.
 
     Args:
-        partial_path (str): Path containing the partial index.
+        partial_path (str): Path containing the runs.
+        names (List[str]): Names of the runs.
+        nparts (int): Number of ranges.
+
+    Returns:
+        List[str]: Increasing split terms, range i is [split[i - 1], split[i]).
     """
-    f_buf = {FileBuffer(partial_path, filename) for filename in os.listdir(partial_path)}
-    f_buf = {f for f in f_buf if f.token is not None}
+    samples = sorted(sample for name in names for sample in read_fences(partial_path, name))
+    total = sum(size for _, size in samples)
+    splits: List[str] = []
+    acc = 0
+    for term, size in samples:
+        if len(splits) == nparts - 1:
+            break
+        if acc >= total * (len(splits) + 1) / nparts and (not splits or term > splits[-1]) and acc:
+            splits.append(term)
+        acc += size
+    return splits
+
+
+def merge_range(
+    partial_path: str,
+    names: List[str],
+    index_path: str,
+    lexicon_path: str,
+    lengths: Sequence[int],
+    avgdl: float,
+    lo: str = None,
+    hi: str = None,
+    pos=0,
+    codec: str = "vbyte",
+    impacts: Optional[Impacts] = None,
+    base: int = 0,
+) -> None:
+    """Merge the terms in [lo, hi) of the runs names into the binary index in index_path, and write
+    its lexicon to lexicon_path. lo and hi default to unbounded. Posting lists are written in blocks
+    with skip data and block maximum scores, see index.blocks.encode_blocks.
+
+    Args:
+        partial_path (str): Path containing the runs.
+        names (List[str]): Names of the runs.
+        index_path (str): Path to write the index to.
+        lexicon_path (str): Path to write the lexicon to.
+        lengths (Sequence[int]): Document lengths indexed by docid - base, see index.meta.load_lengths.
+        avgdl (float): Average document length.
+        lo (str, optional): First term of the range.
+        hi (str, optional): Term right after the range.
+        pos (int, optional): Position of the progress bar.
+        codec (str, optional): Codec of the posting lists, see index.codecs.CODEC_CHOICES. Defaults to "vbyte".
+        impacts (Impacts, optional): Quantization of the impacts stored per posting. Defaults to no impacts.
+        base (int, optional): First docid of the index. Defaults to 0.
+    """
+    f_buf = [FileBuffer(partial_path, filename, MERGE_BLOCK, lo=lo, hi=hi) for filename in names]
     last = ""
+    last_docid = 0
+    df = cf = 0
+    payload = BytesIO()
     cur_word_id = 1
     collect_interval = 10**6
-    with tqdm() as pbar:
-        with open("final/index", "w", encoding="UTF-8") as out:
-            while f_buf:
-                # Of all FileBuffers, get the one with the lexicographically smallest token and docid.
-                m = min(f_buf)
+
+    def write_term(out, lex):
+        start = out.tell()
+        out.write(encode_blocks(*split_postings(payload.getbuffer()), codec, lengths, avgdl, impacts, base))
+        lex.add(last, start, out.tell() - start, df, cf)
+
+    with tqdm(position=pos) as pbar:
+        with open(index_path, "wb") as out, LexiconWriter(lexicon_path) as lex:
+            # Buffers come out in order of lexicographically smallest token and docid.
+            for m in merge_buffers(f_buf):
                 if m.token != last:
                     pbar.update(1)
                     cur_word_id += 1
                     if not cur_word_id % collect_interval:
                         collect()
+                        pbar.set_postfix(merge_rate(f_buf))
                     if last:
-                        out.write("]\n")
+                        write_term(out, lex)
+                        payload = BytesIO()
                     last = m.token
-                    out.write(f"{m.token}: [")
+                    last_docid = 0
+                    df = cf = 0
+
+                splice(m, last_docid, payload)
+                last_docid = m.last
+                df += m.df
+                cf += m.cf
 
-                out.write(",".join([f"({id},{count})" for id, count in m.value()]))
-                out.write(",")
-                m.next()
-                if m.token is None:
-                    f_buf.remove(m)
-                    collect()
+            if last:
+                write_term(out, lex)
 
-            out.write("]")
 
+def merge_indexes(
+    partial_path: str,
+    max_memory: int = 1024,
+    fan_in: int = None,
+    jobs: int = 1,
+    codec: str = "vbyte",
+    impacts: Optional[Impacts] = None,
+    out: str = "final",
+    checkpoint: Optional[Checkpoint] = None,
+) -> None:
+    """Merge the runs (partial indexes) in partial_path into the binary index {out}/index, and write the lexicon
+    mapping each term to the offset and length in bytes of its posting list in the index,
+    its document frequency and its collection frequency.
 
-def merge_counts():
-    """Merge the partial term counts."""
-    with open("final/count", "w", encoding="UTF-8") as out:
-        for filename in os.listdir("cache/partial_counts"):
-            with open(os.path.join("cache/partial_counts", filename), "r", encoding="UTF-8") as f:
-                shutil.copyfileobj(f, out)
+    If there are more runs than can be open at once, they are first merged in passes of fan_in runs
+    (see merge_passes(/2)).
+
+    The document lengths, their average and the first docid are read from {out}/lengths and
+    {out}/meta, so merge_counts(/2) has to run and the metadata has to be written first.
+
+    With jobs > 1 the runs are split by term range (see split_points(/3)) and each range is merged
+    by its own process into a shard, {out}/index.{i} with the lexicon {out}/lexicon.{i}. The ranges'
+    first terms are written to {out}/shards, see query.index.Index.
+
+    Args:
+        partial_path (str): Path containing the partial index.
+        max_memory (int, optional): Memory budget in MB, used to derive fan_in. Defaults to 1024.
+        fan_in (int, optional): Maximum number of runs open at once by each process.
+            Defaults to merge_fan_in(max_memory // jobs).
+        jobs (int, optional): Number of merging processes. Defaults to 1.
+        codec (str, optional): Codec of the posting lists, see index.codecs.CODEC_CHOICES. Defaults to "vbyte".
+        impacts (Impacts, optional): Quantization of the impacts stored per posting. Defaults to no impacts.
+        out (str, optional): Directory of the index. Defaults to "final".
+        checkpoint (Checkpoint, optional): Progress of the build, see merge_passes(/3). Defaults to None.
+    """
+    lengths = load_lengths(os.path.join(out, "lengths"))
+    meta = load_meta(os.path.join(out, "meta"))
+    avgdl, base = meta["avgdl"], meta.get("base", 0)
+    names = merge_passes(partial_path, fan_in or merge_fan_in(max_memory // jobs), checkpoint)
+    splits = split_points(partial_path, names, jobs) if jobs > 1 else []
+    shards = os.path.join(out, "shards")
+    if os.path.exists(shards):
+        os.remove(shards)
+
+    if not splits:
+        merge_range(
+            partial_path,
+            names,
+            os.path.join(out, "index"),
+            os.path.join(out, "lexicon"),
+            lengths,
+            avgdl,
+            codec=codec,
+            impacts=impacts,
+            base=base,
+        )
+    else:
+        bounds = [None] + splits + [None]
+        Parallel(n_jobs=len(bounds) - 1)(
+            delayed(merge_range)(
+                partial_path,
+                names,
+                os.path.join(out, f"index.{i}"),
+                os.path.join(out, f"lexicon.{i}"),
+                lengths,
+                avgdl,
+                bounds[i],
+                bounds[i + 1],
+                i,
+                codec,
+                impacts,
+                base,
+            )
+            for i in range(len(bounds) - 1)
+        )
+        with open(shards, "w", encoding="UTF-8") as f:
+            json.dump(splits, f)
+
+
+def read_counts() -> Iterator[Tuple[int, int]]:
+    """(docid, number of tokens) of every document in the partial term counts."""
+    for filename in os.listdir("cache/partial_counts"):
+        with open(os.path.join("cache/partial_counts", filename), "r", encoding="UTF-8") as f:
+            for line in f:
+                split = line.index(":")
+                yield int(line[:split]), int(line[split + 1 :])
+
+
+def merge_counts(out: str = "final", base: int = 0) -> Tuple[int, int]:
+    """Merge the partial term counts into the docid indexed array of document lengths {out}/lengths,
+    see index.meta.write_lengths.
+
+    Args:
+        out (str, optional): Directory of the index. Defaults to "final".
+        base (int, optional): First docid of the index. Defaults to 0.
+
+    Returns:
+        Tuple[int, int]: Number of documents and total number of tokens.
+    """
+    return write_lengths(os.path.join(out, "lengths"), read_counts(), base)
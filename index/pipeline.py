@@ -0,0 +1,152 @@
+import multiprocessing
+import sys
+import threading
+from queue import Full
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+from .governor import MemoryGovernor
+
+# Exit code of a worker that processed its max_tasks and has to be replaced.
+RECYCLED = 3
+# Seconds between checks of the workers while the reader waits on a full queue.
+POLL_INTERVAL = 1.0
+
+
+def worker_loop(tasks, results, work: Callable, args: Tuple, max_tasks: Optional[int]) -> None:
+    """Body of a worker process: applies work to the tasks until it gets the end of stream (None), or
+    until it processed max_tasks tasks, then it exits with RECYCLED."""
+    done = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        results.put(work(task, *args))
+        done += 1
+        if max_tasks and done >= max_tasks:
+            sys.exit(RECYCLED)
+
+
+class Pipeline:
+    """Streaming producer/consumer pipeline: reader -> bounded task queue -> pool of worker processes ->
+    result queue -> writer thread.
+
+    The caller's thread is the reader, it blocks while the task queue holds depth tasks, so at most
+    depth + jobs tasks are in memory however fast it reads (backpressure). Workers are long lived,
+    each takes the next task as soon as it is done with the last one, so they stay busy until the end
+    of the stream. Results are handed to on_result by the writer thread, in completion order.
+
+    The end of the stream is signalled by one None per worker on the task queue, and then by a None on
+    the result queue once every worker has exited.
+
+    A worker exits after max_tasks tasks and is replaced by a new process, since the memory a python
+    process frees is not always given back to the operating system (see index.index_manager).
+
+    With a governor (see index.governor.MemoryGovernor) the number of workers follows the memory used
+    by the process tree: workers are added while it has room, and recycled workers are not replaced
+    while it is over budget.
+    """
+
+    def __init__(
+        self,
+        work: Callable,
+        args: Tuple,
+        jobs: int,
+        on_result: Callable[[Any], None],
+        depth: Optional[int] = None,
+        max_tasks: Optional[int] = None,
+        governor: Optional[MemoryGovernor] = None,
+    ) -> None:
+        """
+        Args:
+            work (Callable): Module level function applied to each task as work(task, *args).
+            args (Tuple): Extra arguments of work.
+            jobs (int): Number of worker processes, the initial number if there is a governor.
+            on_result (Callable[[Any], None]): Called by the writer thread with the result of each task.
+            depth (int, optional): Maximum number of tasks waiting in the queue. Defaults to 2 * the
+                maximum number of workers.
+            max_tasks (int, optional): Number of tasks after which a worker is replaced. Defaults to never.
+            governor (MemoryGovernor, optional): Sets the number of workers. Defaults to jobs workers.
+        """
+        self.ctx = multiprocessing.get_context("spawn")
+        self.work = work
+        self.args = args
+        self.target = max(1, min(jobs, governor.max_workers) if governor else jobs)
+        self.max_tasks = max_tasks
+        self.on_result = on_result
+        self.governor = governor
+        self.tasks = self.ctx.Queue(depth or 2 * (governor.max_workers if governor else self.target))
+        self.results = self.ctx.Queue()
+        self.workers = []
+        # Set once every task is queued, the workers get their end of stream.
+        self.closing = False
+        self.error: Optional[BaseException] = None
+        self.writer = threading.Thread(target=self.write, daemon=True)
+
+    def start_worker(self) -> None:
+        worker = self.ctx.Process(
+            target=worker_loop, args=(self.tasks, self.results, self.work, self.args, self.max_tasks), daemon=True
+        )
+        worker.start()
+        self.workers.append(worker)
+
+    def reap(self) -> None:
+        """Remove the workers that exited and start workers up to the target. Raises RuntimeError if a
+        worker died."""
+        for worker in [worker for worker in self.workers if worker.exitcode is not None]:
+            self.workers.remove(worker)
+            worker.join()
+            if worker.exitcode not in (0, RECYCLED):
+                raise RuntimeError(f"Worker {worker.pid} died with exit code {worker.exitcode}")
+            # Once closing, the end of stream of a recycled worker is still queued, a new worker takes it.
+            if worker.exitcode == RECYCLED and self.closing:
+                self.start_worker()
+        if self.error is not None:
+            raise self.error
+        if not self.closing:
+            if self.governor:
+                self.target = self.governor.target(len(self.workers))
+            while len(self.workers) < self.target:
+                self.start_worker()
+
+    def put(self, task) -> None:
+        while True:
+            self.reap()
+            try:
+                self.tasks.put(task, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                continue
+
+    def write(self) -> None:
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            try:
+                self.on_result(result)
+            except BaseException as e:  # Raised in the reader's thread by reap(/0).
+                self.error = e
+
+    def run(self, tasks: Iterable) -> None:
+        """Process every task of the stream and wait for their results to be written."""
+        self.writer.start()
+        try:
+            self.reap()
+            for task in tasks:
+                self.put(task)
+            self.closing = True
+            for _ in range(len(self.workers)):
+                self.put(None)
+            while self.workers:
+                self.reap()
+                for worker in self.workers:
+                    worker.join(POLL_INTERVAL)
+        except BaseException:
+            for worker in self.workers:
+                worker.terminate()
+            raise
+        finally:
+            self.results.put(None)
+            self.writer.join()
+        if self.error is not None:
+            raise self.error
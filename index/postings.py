@@ -0,0 +1,92 @@
+from array import array
+from typing import Iterable, List, Tuple
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    """Append value to out as a little-endian base 128 varint (7 bits per byte, high bit set on
+    every byte but the last).
+
+    Args:
+        value (int): Non negative integer to encode.
+        out (bytearray): Buffer to append to.
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buf, pos: int) -> Tuple[int, int]:
+    """Decode the varint starting at buf[pos].
+
+    Args:
+        buf (bytes-like): Buffer containing the varint.
+        pos (int): Position of the first byte of the varint.
+
+    Returns:
+        Tuple[int, int]: The decoded value and the position right after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_postings(postings: Iterable[Tuple[int, int]], last: int = 0) -> bytearray:
+    """Encode (docid, count) pairs, sorted by docid, as varint docid gaps followed by varint counts.
+
+    Args:
+        postings (Iterable[Tuple[int, int]]): Postings sorted by docid.
+        last (int, optional): Docid the first gap is relative to. Defaults to 0.
+
+    Returns:
+        bytearray: The encoded postings.
+    """
+    out = bytearray()
+    for docid, count in postings:
+        encode_varint(docid - last, out)
+        encode_varint(count, out)
+        last = docid
+    return out
+
+
+def decode_postings(buf) -> List[Tuple[int, int]]:
+    """Decode a posting list encoded by encode_postings. O(len(buf))
+
+    Args:
+        buf (bytes-like): The encoded posting list.
+
+    Returns:
+        List[Tuple[int, int]]: The (docid, count) pairs.
+    """
+    postings = []
+    docid = 0
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        gap, pos = decode_varint(buf, pos)
+        count, pos = decode_varint(buf, pos)
+        docid += gap
+        postings.append((docid, count))
+    return postings
+
+
+def split_postings(buf) -> Tuple[array, array]:
+    """Decode postings encoded by encode_postings into arrays of docids and counts."""
+    docids = array("Q")
+    counts = array("Q")
+    docid = 0
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        gap, pos = decode_varint(buf, pos)
+        count, pos = decode_varint(buf, pos)
+        docid += gap
+        docids.append(docid)
+        counts.append(count)
+    return docids, counts
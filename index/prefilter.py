@@ -0,0 +1,137 @@
+import os
+from collections import Counter
+from typing import Optional
+
+from warcio.recordloader import ArcWarcRecord
+
+MEGABYTE = 1024 * 1024
+# Default size in MB above which a document is truncated.
+MAX_DOCUMENT_SIZE = 8
+# Bytes of the payload read to identify binary formats.
+PEEK_SIZE = 512
+# Bytes of the payload read at once.
+READ_SIZE = 64 * 1024
+# Warc records that hold a document, the others (request, metadata, revisit, warcinfo) are skipped.
+RECORD_TYPES = {"response", "resource", "conversion"}
+# Media types that are indexed, a document without a Content-Type is indexed unless its magic bytes say otherwise.
+TEXT_TYPES = {"text/html", "application/xhtml+xml", "text/plain"}
+# Formats that were found in the corpus that should not be processed.
+# Ideally this filtering would've been done in the corpus building stage,
+# since indexing these types of doduments goes beyond the scope of this assignment.
+# The extension is the cheapest check, the headers and the magic bytes catch the rest.
+excluded_formats = {
+    ".mp4",
+    ".png",
+    ".fdm",
+    ".pdf",
+    ".doc",
+    ".dll",
+    ".exe",
+    ".jpg",
+    ".sh",
+    ".yml",
+    ".xsl",
+    ".xml",
+    ".mpq",
+}
+# Signatures of binary formats, at the start of the payload.
+MAGIC_BYTES = (
+    b"\x89PNG",  # png
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",  # gif
+    b"%PDF",  # pdf
+    b"PK\x03\x04",  # zip, docx, xlsx, jar
+    b"\x1f\x8b",  # gzip
+    b"MZ",  # exe, dll
+    b"\x7fELF",  # elf
+    b"\xd0\xcf\x11\xe0",  # doc, xls, msi
+    b"ID3",  # mp3
+    b"OggS",  # ogg
+    b"RIFF",  # wav, avi, webp
+    b"\x1aE\xdf\xa3",  # webm, mkv
+    b"fLaC",  # flac
+    b"Rar!",  # rar
+    b"7z\xbc\xaf",  # 7z
+    b"\x00\x00\x01\x00",  # ico
+    b"wOF",  # woff, woff2
+)
+UTF16_BOMS = (b"\xff\xfe", b"\xfe\xff")
+
+
+def read_at_most(stream, size: int) -> bytes:
+    """Up to size bytes of stream, fewer only at its end (a read of a decompressing stream may return less)."""
+    chunks = []
+    while size > 0:
+        chunk = stream.read(min(size, READ_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def header_skip(url: str, record: ArcWarcRecord) -> Optional[str]:
+    """Why the document of record should not be indexed, from its url and headers, None if it should.
+    O(1), nothing of its payload is read.
+
+    Args:
+        url (str): Its url.
+        record (ArcWarcRecord): The warc record.
+
+    Returns:
+        Optional[str]: "extension", "record-type", "status", "content-type" or "empty".
+    """
+    if os.path.splitext(url)[1].lower() in excluded_formats:
+        return "extension"
+    if record.rec_type not in RECORD_TYPES:
+        return "record-type"
+    headers = record.http_headers
+    if headers is not None and not (headers.get_statuscode() or "200").startswith("2"):
+        return "status"
+    content_type = (headers or record.rec_headers).get_header("Content-Type")
+    if content_type:
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        if media_type and media_type not in TEXT_TYPES:
+            return "content-type"
+    if headers is not None and headers.get_header("Content-Length") == "0":
+        return "empty"
+    return None
+
+
+def magic_skip(head: bytes) -> Optional[str]:
+    """Why a document whose payload starts with head should not be indexed, None if it should: "magic" if it
+    starts with the signature of a binary format or has NUL bytes (and is not UTF-16), "empty" if it is empty."""
+    if not head:
+        return "empty"
+    if head.startswith(MAGIC_BYTES) or head[4:8] == b"ftyp":  # mp4, mov
+        return "magic"
+    if b"\x00" in head and not head.startswith(UTF16_BOMS):
+        return "magic"
+    return None
+
+
+class Payload:
+    """Payload of a warc record whose first PEEK_SIZE bytes were read, to check its magic bytes (see
+    magic_skip(/1)), before the rest is read. It has to be read before the next record is."""
+
+    def __init__(self, record: ArcWarcRecord) -> None:
+        self.stream = record.content_stream()
+        self.head = read_at_most(self.stream, PEEK_SIZE)
+
+    def read(self, max_size: int = MAX_DOCUMENT_SIZE * MEGABYTE, stats: Optional[Counter] = None) -> bytes:
+        """The payload, truncated to max_size bytes. The rest of it is never held in memory, the warc reader
+        skips it in blocks. O(min(len(payload), max_size))
+
+        Args:
+            max_size (int, optional): Size in bytes of the largest payload read whole. Defaults to MAX_DOCUMENT_SIZE MB.
+            stats (Counter, optional): Counts the payloads read in full ("payload.full") and truncated
+                ("payload.truncated").
+
+        Returns:
+            bytes: The payload, or its first max_size bytes.
+        """
+        payload = self.head[:max_size] + read_at_most(self.stream, max_size - len(self.head))
+        truncated = len(payload) == max_size and bool(self.head[max_size:] or self.stream.read(1))
+        if stats is not None:
+            stats["payload.truncated" if truncated else "payload.full"] += 1
+        return payload
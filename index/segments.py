@@ -0,0 +1,262 @@
+import fcntl
+import heapq
+import json
+import math
+import os
+import shutil
+from array import array
+from contextlib import contextmanager
+from itertools import groupby
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from .blocks import PostingList, encode_blocks
+from .checkpoint import pending_build
+from .index_manager import index_manager
+from .lexicon import Lexicon, LexiconEntry, LexiconWriter
+from .mapped import MappedFile
+from .meta import LENGTH_TYPECODE, load_lengths, load_meta, write_index_meta
+from .url_store import UrlStore, UrlStoreWriter
+
+# JSON list of the segment directories of an index, in docid order.
+MANIFEST = "segments"
+# Segments whose numbers of documents are within a factor of MERGE_FACTOR are in the same tier, and
+# MERGE_FACTOR adjacent segments of the same tier are merged into one.
+MERGE_FACTOR = 4
+# Files of an index, besides its shards (index.{i}, lexicon.{i}).
+INDEX_FILES = ("index", "lexicon", "shards", "lengths", "meta", "urls", "aliases")
+
+
+@contextmanager
+def locked(path: str, name: str, blocking: bool = True):
+    """Hold the lock file name in path, yields False if blocking is False and it is already held."""
+    with open(os.path.join(path, name), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_manifest(path: str) -> List[str]:
+    """Names of the segments of the index in path, in docid order. An index without a manifest is a
+    single segment, ".", if it exists."""
+    manifest = os.path.join(path, MANIFEST)
+    if os.path.exists(manifest):
+        with open(manifest, "r", encoding="UTF-8") as f:
+            return json.load(f)
+    return ["."] if os.path.exists(os.path.join(path, "meta")) else []
+
+
+def write_manifest(path: str, names: List[str]) -> None:
+    """Replace the manifest atomically, so readers see either the old or the new segments."""
+    tmp = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp, "w", encoding="UTF-8") as f:
+        json.dump(names, f)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def segment_meta(path: str, name: str) -> Dict:
+    return load_meta(os.path.join(path, name, "meta"))
+
+
+def new_segment(path: str) -> str:
+    """Create the directory of a new segment, seg_{n} with n larger than any existing segment's."""
+    numbers = [int(name[4:]) for name in os.listdir(path) if name.startswith("seg_") and name[4:].isdigit()]
+    name = f"seg_{max(numbers, default=0) + 1}"
+    os.mkdir(os.path.join(path, name))
+    return name
+
+
+def remove_segment(path: str, name: str) -> None:
+    seg_path = os.path.join(path, name)
+    if name != ".":
+        shutil.rmtree(seg_path, ignore_errors=True)
+        return
+    for filename in os.listdir(seg_path):
+        if filename.split(".")[0] in INDEX_FILES and os.path.isfile(os.path.join(seg_path, filename)):
+            os.remove(os.path.join(seg_path, filename))
+
+
+def reset_segments(path: str) -> None:
+    """Remove the manifest and every segment but ".", before a full build."""
+    with locked(path, "segments.lock"):
+        for name in read_manifest(path):
+            if name != ".":
+                remove_segment(path, name)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            os.remove(os.path.join(path, MANIFEST))
+
+
+def add_segment(corpus_path: str, max_memory: int, path: str = "final", resume: bool = False, **kwargs) -> str:
+    """Index the archives in corpus_path into a new segment of the index in path, with docids following
+    those of the last segment. The segment is searchable once it is added to the manifest, the
+    existing segments are not touched.
+
+    Args:
+        corpus_path (str): Path to a zip file containing the warc files.
+        max_memory (int): Max memory in MB that the indexer can use at any given moment.
+        path (str, optional): Directory of the index. Defaults to "final".
+        resume (bool, optional): If an unfinished build of a segment of this index, whose checkpoint is
+            in cache, is continued instead of starting a new segment. Defaults to False.
+        kwargs: Passed on to index_manager(/2).
+
+    Returns:
+        str: Name of the segment.
+    """
+    with locked(path, "segments.lock"):
+        names = read_manifest(path)
+        pending = pending_build("cache") if resume else None
+        if (
+            pending
+            and os.path.dirname(pending["out"]) == path
+            and os.path.isdir(pending["out"])
+            and os.path.basename(pending["out"]) not in names
+        ):
+            name, base = os.path.basename(pending["out"]), pending["base"]
+        else:
+            base = segment_meta(path, names[-1])["end"] if names else 0
+            name = new_segment(path)
+    index_manager(corpus_path, max_memory, out=os.path.join(path, name), base=base, resume=resume, **kwargs)
+    with locked(path, "segments.lock"):
+        write_manifest(path, read_manifest(path) + [name])
+    return name
+
+
+def segment_lists(seg_path: str) -> Iterator[Tuple[LexiconEntry, PostingList]]:
+    """Lexicon entries and posting lists of the index in seg_path, in term order, over all its shards."""
+    shards = os.path.join(seg_path, "shards")
+    if os.path.exists(shards):
+        with open(shards, "r", encoding="UTF-8") as f:
+            parts = [(f"index.{i}", f"lexicon.{i}") for i in range(len(json.load(f)) + 1)]
+    else:
+        parts = [("index", "lexicon")]
+    for index_name, lexicon_name in parts:
+        postings = MappedFile(os.path.join(seg_path, index_name))
+        lexicon = Lexicon(os.path.join(seg_path, lexicon_name))
+        for entry in lexicon:
+            yield entry, PostingList(postings.read(entry.offset, entry.length))
+        lexicon.close()
+        postings.close()
+
+
+def merge_segments(path: str, names: List[str]) -> str:
+    """Merge the adjacent segments names into a new segment, and replace them by it in the manifest.
+    Posting lists of the same term are concatenated in docid order and reencoded, since their block
+    maximums (and impacts) depend on the collection statistics. O(npostings log len(names))
+
+    Args:
+        path (str): Directory of the index.
+        names (List[str]): Names of the segments, in docid order.
+
+    Returns:
+        str: Name of the merged segment.
+    """
+    with locked(path, "segments.lock"):
+        name = new_segment(path)
+    out = os.path.join(path, name)
+    metas = [segment_meta(path, segment) for segment in names]
+    base, end = metas[0]["base"], metas[-1]["end"]
+
+    lengths = array(LENGTH_TYPECODE)
+    with UrlStoreWriter(os.path.join(out, "urls")) as urls:
+        for segment, meta in zip(names, metas):
+            segment_lengths = load_lengths(os.path.join(path, segment, "lengths"))
+            segment_lengths.extend(bytes(meta["end"] - meta["base"] - len(segment_lengths)))
+            lengths += segment_lengths
+            store = UrlStore(os.path.join(path, segment, "urls"))
+            for url in store:
+                urls.add(url)
+            store.close()
+    with open(os.path.join(out, "lengths"), "wb") as f:
+        lengths.tofile(f)
+    # Aliases hold global docids, like the postings, so they are concatenated as they are.
+    aliases = [os.path.join(path, segment, "aliases") for segment in names]
+    if any(os.path.exists(alias) for alias in aliases):
+        with open(os.path.join(out, "aliases"), "wb") as f:
+            for alias in filter(os.path.exists, aliases):
+                with open(alias, "rb") as segment_aliases:
+                    shutil.copyfileobj(segment_aliases, f)
+
+    ndocs = sum(meta["N"] for meta in metas)
+    ntokens = sum(meta["total_tokens"] for meta in metas)
+    codec = metas[0]["codec"]
+    impacts = any(meta.get("impacts") for meta in metas)
+    quantization = write_index_meta(out, ndocs, ntokens, base, end, metas[0]["analyzer"], codec, impacts)
+    avgdl = ntokens / (ndocs or 1)
+
+    # Entries come out by term, then (ties keep the order of the inputs) by segment, so each term's
+    # lists are in docid order.
+    lists = heapq.merge(
+        *[segment_lists(os.path.join(path, segment)) for segment in names], key=lambda item: item[0].term
+    )
+    with open(os.path.join(out, "index"), "wb") as index, LexiconWriter(os.path.join(out, "lexicon")) as lex:
+        for term, group in tqdm(groupby(lists, key=lambda item: item[0].term), desc=f"Merging into {name}"):
+            docids: List[int] = []
+            counts: List[int] = []
+            df = cf = 0
+            for entry, plist in group:
+                for docid, count in plist.postings():
+                    docids.append(docid)
+                    counts.append(count)
+                df += entry.df
+                cf += entry.cf
+            start = index.tell()
+            index.write(encode_blocks(docids, counts, codec, lengths, avgdl, quantization, base))
+            lex.add(term, start, index.tell() - start, df, cf)
+
+    with locked(path, "segments.lock"):
+        manifest = read_manifest(path)
+        i = manifest.index(names[0])
+        manifest[i : i + len(names)] = [name]
+        write_manifest(path, manifest)
+    # Readers that opened the old segments keep their mappings until they close them.
+    for segment in names:
+        remove_segment(path, segment)
+    return name
+
+
+def tier(ndocs: int, factor: int = MERGE_FACTOR) -> int:
+    return int(math.log(max(ndocs, 1), factor))
+
+
+def find_merge(sizes: List[int], factor: int = MERGE_FACTOR) -> Optional[Tuple[int, int]]:
+    """Tiered merge policy: the first factor adjacent segments in the same tier, as a [start, end)
+    range of indexes into sizes, or None if there are none.
+
+    Args:
+        sizes (List[int]): Number of documents of each segment, in docid order.
+        factor (int, optional): Number of segments merged at once, and ratio between tiers.
+            Defaults to MERGE_FACTOR.
+    """
+    for i in range(len(sizes) - factor + 1):
+        if len({tier(size, factor) for size in sizes[i : i + factor]}) == 1:
+            return i, i + factor
+    return None
+
+
+def compact(path: str = "final", factor: int = MERGE_FACTOR) -> None:
+    """Merge segments following the tiered merge policy (see find_merge(/2)) until no tier has factor
+    adjacent segments. Returns right away if another compaction of the index is running.
+
+    Args:
+        path (str, optional): Directory of the index. Defaults to "final".
+        factor (int, optional): Number of segments merged at once. Defaults to MERGE_FACTOR.
+    """
+    with locked(path, "compact.lock", blocking=False) as acquired:
+        if not acquired:
+            return
+        while True:
+            with locked(path, "segments.lock"):
+                names = read_manifest(path)
+                sizes = [segment_meta(path, name)["N"] for name in names]
+            window = find_merge(sizes, factor)
+            if window is None:
+                return
+            merge_segments(path, names[window[0] : window[1]])
+
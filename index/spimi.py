@@ -0,0 +1,80 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+from .file_buffer import RunWriter
+
+MEGABYTE = 1024 * 1024
+
+# Rough size in bytes of the python objects held per posting (tuple, int and list slot) and per new
+# term (str, list and dict entry). Used to estimate the memory held by the inverter.
+POSTING_SIZE = 100
+TERM_SIZE = 250
+
+
+class SpimiInverter:
+    """Single-pass in-memory inverter. Accumulates the postings of many documents in a dictionary that
+    maps terms to their posting lists, until the estimated memory used reaches the budget, then writes
+    them as one run sorted by term (in the binary run format) along with the documents' term
+    counts, and starts over.
+
+    Runs are named {first docid}_{last docid + 1}, documents must be added in docid order.
+    """
+
+    def __init__(self, run_path: str, count_path: str, budget: int) -> None:
+        """
+        Args:
+            run_path (str): Directory to write the runs to.
+            count_path (str): Directory to write the documents' term counts to.
+            budget (int): Memory budget in MB.
+        """
+        self.run_path = run_path
+        self.count_path = count_path
+        self.budget = budget * MEGABYTE
+        # Names of the runs written.
+        self.names: List[str] = []
+        self.reset()
+
+    def reset(self) -> None:
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: List[Tuple[int, int]] = []
+        self.size = 0
+
+    def add(self, idx: int, ntokens: int, counts: Dict[str, int]) -> None:
+        """Add the document idx, with ntokens tokens and the term counts counts. O(len(counts))"""
+        self.lengths.append((idx, ntokens))
+        for token, c in counts.items():
+            plist = self.postings.get(token)
+            if plist is None:
+                plist = self.postings[token] = []
+                self.size += TERM_SIZE
+            plist.append((idx, c))
+        self.size += POSTING_SIZE * len(counts)
+        if self.size >= self.budget:
+            self.flush()
+
+    def flush(self) -> Optional[str]:
+        """Write the accumulated postings as a run. O(nterms log nterms + npostings)
+
+        Returns:
+            Optional[str]: Name of the run (and of the term counts), None if there was nothing to write.
+        """
+        if not self.lengths:
+            return None
+        name = f"{self.lengths[0][0]}_{self.lengths[-1][0] + 1}"
+        counts_path = os.path.join(self.count_path, name)
+        run_path = os.path.join(self.run_path, name)
+
+        # Both are written under a temporary name, so a killed worker never leaves a truncated run.
+        with open(counts_path + ".tmp", "w", encoding="UTF-8") as f:
+            for idx, ntokens in self.lengths:
+                f.write(f"{idx}: {ntokens}\n")
+
+        with RunWriter(run_path + ".tmp") as out:
+            for token in sorted(self.postings):
+                out.add(token, self.postings[token])
+        os.replace(counts_path + ".tmp", counts_path)
+        os.replace(run_path + ".tmp", run_path)
+
+        self.names.append(name)
+        self.reset()
+        return name
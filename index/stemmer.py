@@ -0,0 +1,196 @@
+import heapq
+import os
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from nltk_light.stem import RSLPStemmer
+
+# Words whose stems are cached by default, about 8MB.
+CACHE_SIZE = 32768
+# Words saved by default by Vocabulary.save(/0), the ones a fresh worker is prewarmed with.
+VOCABULARY_SIZE = 8192
+# Vocabulary keeps the counts of up to this many times its size words, the less frequent ones are dropped.
+VOCABULARY_SLACK = 4
+# Key of the rules of a trie node, no character is the empty string.
+RULES = ""
+# A compiled rule: its position in its step, suffix length, minimum stem size, replacement and exceptions.
+Rule = Tuple[int, int, int, str, frozenset]
+
+
+class CompiledRSLP:
+    """RSLPStemmer with its rules compiled. RSLPStemmer.apply_rule tries the rules of a step one by one, slicing
+    the word for each suffix and looking it up in a list of exceptions, O(nrules) per step. Here each step is a
+    trie of the reversed suffixes of its rules, walked from the end of the word, so only the rules whose suffix
+    the word ends with are tried, O(len(word)) per step. Exceptions are sets.
+
+    A step still applies the first rule, in the order of the rule file, whose suffix matches, whose minimum stem
+    size is met and of which the word is not an exception, so the stems are the same as RSLPStemmer's.
+    """
+
+    def __init__(self, stemmer: RSLPStemmer = None) -> None:
+        """
+        Args:
+            stemmer (RSLPStemmer, optional): Stemmer whose rules are compiled. Defaults to a new one.
+        """
+        model = (stemmer or RSLPStemmer())._model
+        self.steps = [self.compile(rules) for rules in model]
+
+    @staticmethod
+    def compile(rules: List[List]) -> Dict:
+        """Trie of the reversed suffixes of rules (parsed by RSLPStemmer.read_rule), each node keeps the rules
+        with its suffix under RULES, in their order."""
+        root: Dict = {}
+        for order, (suffix, min_size, replacement, exceptions) in enumerate(rules):
+            node = root
+            for char in reversed(suffix):
+                node = node.setdefault(char, {})
+            node.setdefault(RULES, []).append((order, len(suffix), min_size, replacement, frozenset(exceptions)))
+        return root
+
+    def apply_rule(self, word: str, step: int) -> str:
+        """word with the rule of step that applies to it applied, see RSLPStemmer.apply_rule. O(len(word))"""
+        node = self.steps[step]
+        length = len(word)
+        best: Rule = None
+        i = length
+        while True:
+            # An empty suffix only matches the empty word (word[-0:] is the whole word).
+            rules = node.get(RULES) if i < length or not length else None
+            if rules:
+                for rule in rules:
+                    if best is not None and rule[0] > best[0]:
+                        break
+                    if length >= rule[1] + rule[2] and word not in rule[4]:
+                        best = rule
+                        break
+            if not i:
+                break
+            i -= 1
+            node = node.get(word[i])
+            if node is None:
+                break
+        if best is None:
+            return word
+        return word[: length - best[1]] + best[3]
+
+    def stem(self, word: str) -> str:
+        """Stem of word, the steps are those of RSLPStemmer.stem."""
+        word = word.lower()
+
+        # the word ends in 's'? apply rule for plural reduction
+        if word[-1] == "s":
+            word = self.apply_rule(word, 0)
+
+        # the word ends in 'a'? apply rule for feminine reduction
+        if word[-1] == "a":
+            word = self.apply_rule(word, 1)
+
+        # augmentative reduction
+        word = self.apply_rule(word, 3)
+
+        # adverb reduction
+        word = self.apply_rule(word, 2)
+
+        # noun reduction
+        prev_word = word
+        word = self.apply_rule(word, 4)
+        if word == prev_word:
+            # verb reduction
+            prev_word = word
+            word = self.apply_rule(word, 5)
+            if word == prev_word:
+                # vowel removal
+                word = self.apply_rule(word, 6)
+
+        return word
+
+
+class CachedStemmer:
+    """RSLP stemmer (see CompiledRSLP) with a bounded LRU cache of stems. Word frequencies are Zipfian, so most of
+    the calls are for the same few thousand words, and are answered without running RSLP's rule passes.
+
+    The cache is an OrderedDict in recency order: a hit moves the word to the end, a miss past size
+    evicts the word at the start. Each cached word keeps its stem and how many times it was stemmed, so
+    the most frequent words can be collected in a Vocabulary, to prewarm the stemmer of a fresh process.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE) -> None:
+        """
+        Args:
+            size (int, optional): Maximum number of words cached. Defaults to CACHE_SIZE.
+        """
+        self.stemmer = CompiledRSLP()
+        self.size = size
+        self.cache: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def stem(self, word: str) -> str:
+        """Stem of word, see RSLPStemmer.stem. O(1) if it is cached, O(len(word)) otherwise."""
+        entry = self.cache.get(word)
+        if entry is not None:
+            self.hits += 1
+            entry[1] += 1
+            self.cache.move_to_end(word)
+            return entry[0]
+        self.misses += 1
+        stem = self.stemmer.stem(word)
+        self.cache[word] = [stem, 1]
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return stem
+
+    def prewarm(self, words: Iterable[str]) -> None:
+        """Cache the stems of words, without counting them as misses or as stemmed."""
+        for word in words:
+            if word not in self.cache:
+                self.cache[word] = [self.stemmer.stem(word), 0]
+                if len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+
+    def load(self, path: str) -> None:
+        """Prewarm with the words saved to path by Vocabulary.save(/0), if it exists."""
+        if os.path.exists(path):
+            with open(path, "r", encoding="UTF-8") as f:
+                self.prewarm(f.read().splitlines())
+
+    def frequent(self, n: int = VOCABULARY_SIZE) -> List[Tuple[str, int]]:
+        """The n cached words stemmed the most times, with their counts, most frequent first. O(size log n)"""
+        top = heapq.nlargest(n, ((entry[1], word) for word, entry in self.cache.items() if entry[1]))
+        return [(word, count) for count, word in top]
+
+    def hit_rate(self) -> float:
+        return self.hits / ((self.hits + self.misses) or 1)
+
+
+class Vocabulary:
+    """Words stemmed by the workers, whose counts (see CachedStemmer.frequent(/1)) are added up in the main
+    process. Its most frequent words are saved to path, for the stemmers of the next workers to load, so the
+    file has the words that are frequent over the whole corpus instead of those of the last worker done.
+    """
+
+    def __init__(self, path: str, size: int = VOCABULARY_SIZE) -> None:
+        """
+        Args:
+            path (str): File the words are saved to.
+            size (int, optional): Number of words saved. Defaults to VOCABULARY_SIZE.
+        """
+        self.path = path
+        self.size = size
+        self.counts: Counter = Counter()
+
+    def add(self, frequent: List[Tuple[str, int]]) -> None:
+        """Add the counts of a worker's most frequent words. O(len(frequent))"""
+        self.counts.update(dict(frequent))
+        if len(self.counts) > VOCABULARY_SLACK * self.size:
+            self.counts = Counter(dict(self.counts.most_common(self.size)))
+
+    def save(self) -> None:
+        """Write the size most frequent words to path, one per line, least frequent first (so the most
+        frequent are the most recent after CachedStemmer.load(/1)). The file is replaced atomically, workers
+        may be loading it."""
+        words = [word for word, _ in reversed(self.counts.most_common(self.size))]
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="UTF-8") as f:
+            f.writelines(word + "\n" for word in words)
+        os.replace(tmp, self.path)
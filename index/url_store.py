@@ -0,0 +1,109 @@
+import struct
+from array import array
+from typing import Iterator
+
+from .mapped import MappedFile
+from .postings import decode_varint, encode_varint
+
+# Footer: number of urls, offset of the block offsets table, magic.
+FOOTER = struct.Struct("<QQ4s")
+MAGIC = b"URL1"
+# Number of urls per front coded block.
+URL_BLOCK = 16
+
+
+class UrlStoreWriter:
+    """Writes the urls of the documents, in docid order starting at 0.
+
+    Urls are front coded in blocks of URL_BLOCK: the first url of a block is stored whole, the others
+    as the length of the prefix they share with the previous url and the rest of the url, all lengths
+    as varints. The blocks are followed by a table with the offset of each block and a fixed size
+    footer, like the lexicon (see index.lexicon.LexiconWriter).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.fp = open(path, "wb")
+        self.starts = array("Q")
+        self.block = bytearray()
+        self.pos = 0
+        self.n = 0
+        self.prev = b""
+
+    def add(self, url: str) -> None:
+        encoded = url.encode("UTF-8")
+        if not self.n % URL_BLOCK:
+            self.flush()
+            self.starts.append(self.pos)
+            self.prev = b""
+        shared = 0
+        limit = min(len(encoded), len(self.prev))
+        while shared < limit and encoded[shared] == self.prev[shared]:
+            shared += 1
+        encode_varint(shared, self.block)
+        encode_varint(len(encoded) - shared, self.block)
+        self.block += encoded[shared:]
+        self.prev = encoded
+        self.n += 1
+
+    def flush(self) -> None:
+        self.fp.write(self.block)
+        self.pos += len(self.block)
+        self.block = bytearray()
+
+    def close(self) -> None:
+        self.flush()
+        self.starts.tofile(self.fp)
+        self.fp.write(FOOTER.pack(self.n, self.pos, MAGIC))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class UrlStore:
+    """Read only view of the urls written by UrlStoreWriter. The file is memory mapped, opening it
+    reads only the footer and looking up a docid decodes at most URL_BLOCK urls of its block. O(1)"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = MappedFile(path)
+        self.n, self.table_offset, magic = FOOTER.unpack(self.file.read(len(self.file) - FOOTER.size, FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a url store")
+        self.starts = self.file.read(self.table_offset, ((self.n + URL_BLOCK - 1) // URL_BLOCK) * 8).cast("Q")
+
+    def close(self) -> None:
+        self.starts.release()
+        self.file.close()
+
+    def __getitem__(self, docid: int) -> str:
+        if not 0 <= docid < self.n:
+            raise KeyError(docid)
+        block = docid // URL_BLOCK
+        start = self.starts[block]
+        end = self.starts[block + 1] if block + 1 < len(self.starts) else self.table_offset
+        buf = self.file.read(start, end - start)
+        pos = 0
+        url = b""
+        for _ in range(docid % URL_BLOCK + 1):
+            shared, pos = decode_varint(buf, pos)
+            size, pos = decode_varint(buf, pos)
+            url = url[:shared] + bytes(buf[pos : pos + size])
+            pos += size
+        return url.decode("UTF-8")
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __iter__(self) -> Iterator[str]:
+        for docid in range(self.n):
+            yield self[docid]
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
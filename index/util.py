@@ -1,14 +1,22 @@
 import os
-from collections import OrderedDict
-from gc import collect
-from typing import Iterable, Tuple
+import re
+from collections import Counter, OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
 from contextlib import closing
 
 from bs4 import BeautifulSoup, SoupStrainer
 from tqdm import tqdm
 from warcio.archiveiterator import ArchiveIterator
+from warcio.recordloader import ArcWarcRecord
 import zipp
 
+from .charset import decode
+from .checkpoint import Checkpoint
+from .dedup import Deduplicator, exact_signature, near_signature
+from .prefilter import MAX_DOCUMENT_SIZE, MEGABYTE, Payload, header_skip, magic_skip
+from .url_store import UrlStoreWriter
+from .visible import iter_visible, tag_visible
+
 # Stopwords obtained from nltk.stopwords. Those are hardcoded here because nltk's function returns a list, and a set is more apropiate for string lookups
 ignored_words = {
     "de",
@@ -224,22 +232,45 @@ def count(dic: OrderedDict, word: str) -> OrderedDict:
     return dic
 
 
-def tag_visible(*tag):
-    """Visible tags filter."""
-    if tag[0] in [
-        "html",
-        "style",
-        "script",
-        "head",
-        "meta",
-        "[document]",
-    ]:
-        return False
-    return True
+# Tokenizers of the analyzer, see fast_tokenize(/1).
+TOKENIZER_CHOICES = ("nltk", "fast")
+# Words made only of letters: runs of word characters without digits or underscores. Words with any are skipped
+# whole, as the token filter does with the tokens of word_tokenize.
+LETTER_WORD = re.compile(r"(?<!\w)[^\W\d_]+(?!\w)")
+
+
+def fast_tokenize(text: str) -> Tuple[int, List[str]]:
+    """Single pass alternative to word_tokenize(text, "portuguese") followed by the token filter and the stopword
+    removal: one compiled regex finds the words of the lowercased text made only of letters, and the stopwords are
+    dropped as they are listed. There is no sentence splitting, and punctuation is never tokenized, so
+    "guarda-chuva" is two words instead of a token the filter drops. O(len(text))
+
+    Args:
+        text (str): Text to tokenize.
+
+    Returns:
+        Tuple[int, List[str]]: The number of words, and the words that are not stopwords.
+    """
+    words = LETTER_WORD.findall(text.lower())
+    return len(words), [word for word in words if word not in ignored_words]
 
 
 def get_visible(html: str) -> str:
-    """Get the visible text from html. Probably O(len(html))
+    """Get the visible text from html, its strings of visible text (see index.visible.VisibleTextParser)
+    separated by spaces. O(len(html))
+
+    Args:
+        html (str): An html document (hopefully).
+
+    Returns:
+        str: The visible text from the html.
+    """
+    return " ".join(iter_visible(html))
+
+
+def get_visible_soup(html: str) -> str:
+    """get_visible(/1) with BeautifulSoup, which builds the whole tree of the document. Kept as the reference
+    get_visible is checked against (see benchmark.py visible). Probably O(len(html))
 
     Args:
         html (str): An html document (hopefully).
@@ -254,63 +285,163 @@ def get_visible(html: str) -> str:
     return visible_text
 
 
-# Formats that were found in the corpus that should not be processed.
-# Ideally this filtering would've been done in the corpus building stage,
-# since indexing these types of doduments goes beyond the scope of this assignment
-# and checking the filetype just by the url is not very reliable, and loading each file
-# to check for the type uses too much memory.
-excluded_formats = {
-    ".mp4",
-    ".png",
-    ".fdm",
-    ".pdf",
-    ".doc",
-    ".dll",
-    ".exe",
-    ".jpg",
-    ".sh",
-    ".yml",
-    ".xsl",
-    ".xml",
-    ".mpq",
-}
+def warc_members(documents_path: str) -> List[str]:
+    """Names of the warc files in the zip file documents_path, in the order their documents get docids."""
+    return [file.name for file in zipp.Path(documents_path).iterdir() if file.suffix == ".kaggle"]
 
 
-def warc_loader(documents_path: str, total) -> Iterable[Tuple[bytes, int]]:
-    """Generator that yields the documents in each warc file in the zip file specified by documents_path, at the same
-    time it writes a bijective mapping of integers to the urls of the documents.
+def member_records(
+    documents_path: str, member: str, stats: Optional[Counter] = None
+) -> Iterator[Tuple[str, ArcWarcRecord, Payload]]:
+    """Generator that decodes the warc file member of the zip file documents_path, yielding the url, record and
+    payload of each document that should be indexed. Documents are filtered first by their url and headers (see
+    index.prefilter.header_skip), then by the first bytes of their payload (see index.prefilter.magic_skip), the
+    payloads of the documents skipped are never read.
 
     Args:
-        documents_path (str): Path to a zip file containing the warc files.
+        documents_path (str): Path to the zip file containing the warc files.
+        member (str): Name of the warc file.
+        stats (Counter, optional): Counts the documents yielded ("filter.accepted") and skipped, by reason
+            ("filter.extension", "filter.content-type", ...).
 
     Yields:
-        Tuple[bytes, int]: The document and its index
+        Tuple[str, ArcWarcRecord, Payload]: The url, record and payload of a document, see index.prefilter.Payload.
     """
-    with tqdm(total=total) as pbar:
-        with open("final/url_index", "w", encoding="UTF-8") as urlidx:
-            idx = 0
-            root = zipp.Path(documents_path)
-            for file in root.iterdir():
-                if file.suffix != ".kaggle":
-                    continue
-                with file.open(mode="rb") as stream:
-                    with closing(ArchiveIterator(stream)) as ai:
-                        for record in ai:
-                            url: str = record.rec_headers.get_header("WARC-Target-URI")
+    with (zipp.Path(documents_path) / member).open(mode="rb") as stream:
+        with closing(ArchiveIterator(stream)) as ai:
+            for record in ai:
+                url: str = record.rec_headers.get_header("WARC-Target-URI") or ""
+                reason = header_skip(url, record)
+                payload = None
+                if reason is None:
+                    payload = Payload(record)
+                    reason = magic_skip(payload.head)
+                if stats is not None:
+                    stats["filter." + (reason or "accepted")] += 1
+                if reason is None:
+                    yield url, record, payload
 
-                            if os.path.splitext(url)[1].lower() in excluded_formats:
-                                pbar.update(1)
-                                continue
 
-                            doc = record.content_stream().read()
-                            urlidx.write(f'{idx}: "{url}",\n')
-                            pbar.update(1)
-                            yield doc, idx
-                            idx += 1
+def scan_member(
+    member: str,
+    documents_path: str,
+    signatures: Optional[str] = None,
+    plaintext=False,
+    max_document_size: int = MAX_DOCUMENT_SIZE,
+) -> Tuple[str, List[str], Optional[List[Tuple[int, Optional[int]]]]]:
+    """The urls of the documents in member, in order, and their signatures if they are deduplicated (see
+    index.dedup). Without signatures only the first bytes of the payloads are read. Runs in a worker process,
+    see DocidAllocator.
 
-                collect()
+    Args:
+        member (str): Name of the warc file.
+        documents_path (str): Path to the zip file containing the warc files.
+        signatures (str, optional): None, "exact" for the hash of each payload, or "near" for its SimHash too,
+            which decodes the documents. Defaults to None.
+        plaintext (bool, optional): If the documents are plaintext, for the SimHash. Defaults to False.
+        max_document_size (int, optional): Size in MB documents are truncated to, as when they are counted.
+
+    Returns:
+        Tuple[str, List[str], Optional[List[Tuple[int, Optional[int]]]]]: member, the urls and the signatures.
+    """
+    urls = []
+    sigs = [] if signatures else None
+    for url, record, payload in member_records(documents_path, member):
+        urls.append(url)
+        if not signatures:
+            continue
+        document = payload.read(max_document_size * MEGABYTE)
+        simhash = None
+        if signatures == "near":
+            headers = record.http_headers or record.rec_headers
+            text = decode(document, headers.get_header("Content-Type"))
+            simhash = near_signature(text if plaintext else get_visible(text))
+        sigs.append((exact_signature(document), simhash))
+    return member, urls, sigs
 
 
-def partitioned_loader(loader, n):
-    for _ in range(n):
-        yield next(loader)
+class DocidAllocator:
+    """Assigns consecutive docid ranges to the warc files, in their order in the zip file, from the urls of their
+    documents, and writes the urls to {out}/urls (see index.url_store), a bijective mapping of integers to the urls
+    of the documents. Members can be added in any order, their urls are held until the members before them are
+    added. Members scanned by a previous build are taken from the checkpoint.
+
+    With a deduplicator, documents that duplicate one before them (see index.dedup.Deduplicator) get no docid, their
+    positions in their member are kept in skipped, to be skipped when counting. In the "alias" mode their urls are
+    written to {out}/aliases, each after the docid of its canonical document and a tab.
+    """
+
+    def __init__(
+        self,
+        members: List[str],
+        out: str,
+        start: int,
+        checkpoint: Optional[Checkpoint] = None,
+        total=None,
+        dedup: str = "off",
+        near: bool = False,
+    ) -> None:
+        """
+        Args:
+            members (List[str]): Names of the warc files, see warc_members(/1).
+            out (str): Directory of the index.
+            start (int): Index of the first document.
+            checkpoint (Checkpoint, optional): Progress of the build, records the range and urls of each member.
+            total (int, optional): Number of documents in the corpus, for the progress bar.
+            dedup (str, optional): One of index.dedup.DEDUP_MODES. Defaults to "off".
+            near (bool, optional): If near duplicates are found too. Defaults to False.
+        """
+        self.members = members
+        self.checkpoint = checkpoint
+        self.next = 0
+        self.idx = start
+        self.pending: Dict[str, Tuple[List[str], Optional[List]]] = {}
+        self.ranges: Dict[str, Tuple[int, int]] = {}
+        self.urlidx = UrlStoreWriter(os.path.join(out, "urls"))
+        self.pbar = tqdm(total=total, desc="Scanning")
+        self.dedup = Deduplicator(near) if dedup != "off" else None
+        self.aliases = open(os.path.join(out, "aliases"), "w", encoding="UTF-8") if dedup == "alias" else None
+        self.skipped: Dict[str, List[int]] = {}
+        # Number of duplicates of each canonical docid.
+        self.duplicates: Dict[int, int] = {}
+
+    def add(self, scanned: Tuple[str, List[str], Optional[List]]) -> None:
+        member, urls, signatures = scanned
+        self.pending[member] = urls, signatures
+        self.advance()
+
+    def advance(self) -> None:
+        """Give docids to the members that are next in order and were added, or were scanned by a previous build
+        (their urls are in the checkpoint)."""
+        while self.next < len(self.members):
+            member = self.members[self.next]
+            scanned = self.pending.pop(member, None)
+            if scanned is None and self.checkpoint:
+                scanned = self.checkpoint.member_scan(member)
+            if scanned is None:
+                return
+            urls, signatures = scanned
+            start = self.idx
+            skipped = []
+            for position, url in enumerate(urls):
+                canonical = self.dedup.check(signatures[position], self.idx) if self.dedup else None
+                if canonical is None:
+                    self.urlidx.add(url)
+                    self.idx += 1
+                    continue
+                skipped.append(position)
+                self.duplicates[canonical] = self.duplicates.get(canonical, 0) + 1
+                if self.aliases:
+                    self.aliases.write(f"{canonical}\t{url}\n")
+            self.ranges[member] = (start, self.idx)
+            self.skipped[member] = skipped
+            if self.checkpoint and not self.checkpoint.is_scanned(member):
+                self.checkpoint.read_member(member, start, self.idx, urls, signatures)
+            self.next += 1
+            self.pbar.update(len(urls))
+
+    def close(self) -> None:
+        self.urlidx.close()
+        if self.aliases:
+            self.aliases.close()
+        self.pbar.close()
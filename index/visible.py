@@ -0,0 +1,178 @@
+from html.entities import html5
+from html.parser import HTMLParser
+from typing import Dict, Iterator, List
+
+# Characters of the named character references, by name without the ";" (the first one in name order
+# when a name exists with and without it), as BeautifulSoup resolves them.
+ENTITIES: Dict[str, str] = {}
+for _name, _character in sorted(html5.items()):
+    ENTITIES.setdefault(_name.rstrip(";"), _character)
+
+# Tags that never have content, they are closed as soon as they are opened.
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta", "param",
+    "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer",
+}  # fmt: skip
+# Text inside these tags is not text of the page (get_text leaves it out).
+HIDDEN_TEXT_TAGS = {"rt", "rp", "style", "script", "template"}
+# Whitespace only text inside these tags is kept as is, elsewhere it is collapsed to a single character.
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+# Characters of html fed to the parser at once by iter_visible(/2).
+CHUNK_SIZE = 64 * 1024
+
+
+def tag_visible(*tag):
+    """Visible tags filter."""
+    if tag[0] in [
+        "html",
+        "style",
+        "script",
+        "head",
+        "meta",
+        "[document]",
+    ]:
+        return False
+    return True
+
+
+class VisibleTextParser(HTMLParser):
+    """Streaming version of BeautifulSoup(html, "html.parser", parse_only=SoupStrainer(tag_visible))
+    .get_text(separator=" "), that keeps only the stack of open tag names instead of building a tree.
+
+    Like the SoupStrainer, tag_visible only filters tags opened outside of any kept tag: text outside
+    of a kept tag (in the head, or between the tags of an excluded html tag) is dropped, but a kept tag
+    keeps all of its content. Within it, the text of script, style, template, rt and rp tags, comments
+    and declarations are dropped, as get_text does. Tags are opened and closed the way BeautifulSoup's
+    html.parser tree builder does it, so the strings are the same ones.
+
+    Strings are appended to self.strings as they end, see iter_visible(/2).
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.strings: List[str] = []
+        self.stack: List[str] = []
+        self.data: List[str] = []
+        self.hidden = 0
+        self.preserve = 0
+        self.closed_void: List[str] = []
+
+    def end_data(self, kind: str = "text") -> None:
+        if not self.data:
+            return
+        data = "".join(self.data)
+        self.data = []
+        if not self.preserve and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        if not self.stack or kind not in ("text", "cdata") or (kind == "text" and self.hidden):
+            return
+        self.strings.append(data)
+
+    def push(self, name: str) -> None:
+        self.stack.append(name)
+        self.hidden += name in HIDDEN_TEXT_TAGS
+        self.preserve += name in PRESERVE_WHITESPACE_TAGS
+
+    def pop_to(self, name: str) -> None:
+        """Close the most recent open tag name and the tags opened after it, if it is open."""
+        if name not in self.stack:
+            return
+        while True:
+            popped = self.stack.pop()
+            self.hidden -= popped in HIDDEN_TEXT_TAGS
+            self.preserve -= popped in PRESERVE_WHITESPACE_TAGS
+            if popped == name:
+                return
+
+    def start(self, name: str, close_void: bool) -> None:
+        self.end_data()
+        if not self.stack and not tag_visible(name):
+            return
+        self.push(name)
+        if close_void and name in VOID_TAGS:
+            self.end_data()
+            self.pop_to(name)
+            # An explicit end tag that follows is ignored.
+            self.closed_void.append(name)
+
+    def handle_starttag(self, tag, attrs):
+        self.start(tag, True)
+
+    def handle_startendtag(self, tag, attrs):
+        self.start(tag, False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void:
+            self.closed_void.remove(tag)
+            return
+        self.end_data()
+        self.pop_to(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        code = int(name.lstrip("xX"), 16) if name[:1] in ("x", "X") else int(name)
+        data = None
+        if code < 256:
+            # References to windows-1252 characters that are not the unicode ones.
+            try:
+                data = bytes([code]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(code)
+            except (ValueError, OverflowError):
+                pass
+        self.data.append(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name):
+        self.data.append(ENTITIES.get(name, "&" + name))
+
+    def handle_comment(self, data):
+        self.end_data()
+        self.data.append(data)
+        self.end_data("comment")
+
+    def handle_decl(self, decl):
+        self.end_data()
+        self.data.append(decl)
+        self.end_data("decl")
+
+    def unknown_decl(self, data):
+        self.end_data()
+        cdata = data.upper().startswith("CDATA[")
+        self.data.append(data[len("CDATA[") :] if cdata else data)
+        self.end_data("cdata" if cdata else "decl")
+
+    def handle_pi(self, data):
+        self.end_data()
+        self.data.append(data)
+        self.end_data("pi")
+
+    def close(self):
+        super().close()
+        self.end_data()
+
+
+def iter_visible(html: str, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Generator of the strings of visible text of html (see VisibleTextParser), fed to the parser in
+    chunks of chunk_size characters, so only the strings of a chunk are held at once. O(len(html))
+
+    Args:
+        html (str): An html document (hopefully).
+        chunk_size (int, optional): Characters parsed at once. Defaults to CHUNK_SIZE.
+
+    Yields:
+        str: The strings of visible text, in document order.
+    """
+    parser = VisibleTextParser()
+    for start in range(0, len(html), chunk_size):
+        parser.feed(html[start : start + chunk_size])
+        yield from parser.strings
+        parser.strings = []
+    parser.close()
+    yield from parser.strings
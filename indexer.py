@@ -2,10 +2,17 @@ import argparse
 import os
 import resource
 import shutil
+import subprocess
 import sys
 from zipfile import ZipFile
 
+from index.codecs import CODEC_CHOICES
+from index.dedup import DEDUP_MODES
 from index.index_manager import index_manager
+from index.prefilter import MAX_DOCUMENT_SIZE
+from index.segments import add_segment, compact, reset_segments
+from index.util import TOKENIZER_CHOICES
+from query.index import export_text
 
 MEGABYTE = 1024 * 1024
 
@@ -22,13 +29,65 @@ def mkdir_safe(dir: str):
         pass
 
 
-def main(mem: int):
+def compact_in_background(mem: int):
+    """Run the segment merge policy in a detached indexer process, that outlives this one."""
+    subprocess.Popen(
+        [sys.executable, sys.argv[0], "-m", str(mem), "--compact"],
+        start_new_session=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def main(
+    mem: int,
+    text: bool,
+    codec: str,
+    impacts: bool,
+    add: str = None,
+    resume: bool = False,
+    max_size: int = MAX_DOCUMENT_SIZE,
+    dedup: str = "off",
+    near: bool = False,
+    tokenizer: str = "nltk",
+):
     mkdir_safe("final")
+    if add is None:
+        reset_segments("final")
+    if not resume:
+        shutil.rmtree("cache", ignore_errors=True)
     mkdir_safe("cache")
     mkdir_safe("cache/partial_counts")
-    mkdir_safe("cache/partial_indexes")
-    mkdir_safe("cache/pre_ind")
-    index_manager("archive.zip", mem, ndocs=950493, plaintext=False)
+    mkdir_safe("cache/runs")
+    if add is None:
+        index_manager(
+            "archive.zip",
+            mem,
+            ndocs=950493,
+            plaintext=False,
+            codec=codec,
+            impacts=impacts,
+            resume=resume,
+            max_document_size=max_size,
+            dedup=dedup,
+            near=near,
+            tokenizer=tokenizer,
+        )
+        if text:
+            export_text("final/index", "final/index.txt")
+    else:
+        add_segment(
+            add,
+            mem,
+            codec=codec,
+            impacts=impacts,
+            resume=resume,
+            max_document_size=max_size,
+            dedup=dedup,
+            near=near,
+            tokenizer=tokenizer,
+        )
+        compact_in_background(mem)
     shutil.rmtree("cache")
 
 
@@ -38,10 +97,80 @@ if __name__ == "__main__":
     parser.add_argument(
         "-m", dest="memory_limit", action="store", required=True, type=int, help="memory available"
     )
+    parser.add_argument(
+        "-t", dest="text_index", action="store_true", help="also export the index in the text format"
+    )
+    parser.add_argument(
+        "-c",
+        dest="codec",
+        action="store",
+        default="vbyte",
+        choices=CODEC_CHOICES,
+        help='postings codec, "adaptive" picks one per posting list',
+    )
+    parser.add_argument(
+        "-q", dest="impacts", action="store_true", help="store quantized BM25 and TF-IDF scores in the postings"
+    )
+    parser.add_argument(
+        "-a",
+        dest="add",
+        action="store",
+        type=str,
+        help="index the archives in this zip file as a new segment of the existing index",
+    )
+    parser.add_argument(
+        "--compact", action="store_true", help="only merge the index's segments, following the tiered merge policy"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last build from its checkpoint in cache, instead of starting over",
+    )
+    parser.add_argument(
+        "-s",
+        dest="max_size",
+        action="store",
+        default=MAX_DOCUMENT_SIZE,
+        type=int,
+        help="size in MB documents are truncated to",
+    )
+    parser.add_argument(
+        "-d",
+        dest="dedup",
+        action="store",
+        default="off",
+        choices=DEDUP_MODES,
+        help='duplicate documents are not indexed, "alias" lists their urls in final/aliases, "skip" drops them',
+    )
+    parser.add_argument(
+        "--near", action="store_true", help="with -d, documents with almost the same text are duplicates too"
+    )
+    parser.add_argument(
+        "-k",
+        dest="tokenizer",
+        action="store",
+        default="nltk",
+        choices=TOKENIZER_CHOICES,
+        help='tokenizer, "fast" extracts lowercased letter-only words in one regex pass instead of word_tokenize',
+    )
     args = parser.parse_args()
     memory_limit(args.memory_limit)
     try:
-        main(args.memory_limit)
+        if args.compact:
+            compact("final")
+        else:
+            main(
+                args.memory_limit,
+                args.text_index,
+                args.codec,
+                args.impacts,
+                args.add,
+                args.resume,
+                args.max_size,
+                args.dedup,
+                args.near,
+                args.tokenizer,
+            )
     except MemoryError:
         sys.stderr.write("\n\nERROR: Memory Exception\n")
         sys.exit(1)
@@ -1,62 +1,142 @@
-import ast
-from typing import List, TextIO
+import json
+import os
+from bisect import bisect_right
+from typing import Dict, Iterator, List, Optional
 
-from .structs import Tup
+from index.blocks import PostingList
+from index.lexicon import Lexicon, LexiconEntry
+from index.mapped import MappedFile
+from index.meta import Lengths, load_meta
+from index.segments import read_manifest
+from index.url_store import UrlStore
+
+
+def lexicon_path(index_path: str) -> str:
+    """Path to the lexicon of the index in index_path."""
+    return os.path.join(os.path.dirname(index_path), "lexicon")
+
+
+def shards_path(index_path: str) -> str:
+    """Path to the list of term ranges of the index in index_path, if it is sharded."""
+    return os.path.join(os.path.dirname(index_path), "shards")
 
 
 class Index:
     def __init__(self, index_path: str) -> None:
-        print("Creating index")
-        self.idfp = open(index_path, "r", encoding="UTF-8")
-        self.set_offsets()
-        self.cur_line = 0
+        """Reader for the index in index_path. The posting lists are decoded straight from a memory
+        mapping of the index, with positional reads, so an Index can be shared by concurrent queries,
+        and processes reading the same index share the page cache. Picklable, the mappings are
+        reopened in the receiving process.
+
+        If the index was merged into shards by term range, the shards {index_path}.{i} are read as a
+        single index, each term is looked up in the shard whose range contains it.
+        """
+        self.splits: List[str] = []
+        if os.path.exists(shards_path(index_path)):
+            with open(shards_path(index_path), "r", encoding="UTF-8") as f:
+                self.splits = json.load(f)
+            paths = [(f"{index_path}.{i}", f"{lexicon_path(index_path)}.{i}") for i in range(len(self.splits) + 1)]
+        else:
+            paths = [(index_path, lexicon_path(index_path))]
+        self.postings = [MappedFile(ipath) for ipath, _ in paths]
+        self.lexicons = [Lexicon(lpath) for _, lpath in paths]
 
     def close(self):
-        self.idfp.close()
+        for postings, lexicon in zip(self.postings, self.lexicons):
+            postings.close()
+            lexicon.close()
 
-    def set_offsets(self):
-        """Creates a dictionary that maps tokens to their offset in bytes in the file. O(filesize)
-        """
-        print("Setting offsets")
-        self.line_offset = {}
-        offset = 0
-        for line in self.idfp:
-            split = line.index(":")
-
-            self.line_offset[line[:split]] = offset
-            offset += len(line.encode("utf-8"))
-        self.idfp.seek(0)
-
-    def get_value(self, i: int):
-        self.idfp.seek(i)
-        line = self.idfp.readline()
-        split = line.index(":")
-        return ast.literal_eval(line[split + 1 :])
-
-    def next_line(self):
-        self.idfp.seek(self.line_offset[self.cur_line + 1])
-        self.cur_line += 1
+    def shard(self, key: str) -> int:
+        """Shard whose term range contains key. O(log nshards)"""
+        return bisect_right(self.splits, key)
+
+    def posting_list(self, entry: LexiconEntry) -> PostingList:
+        """Posting list of entry, only its skip entries are decoded."""
+        return PostingList(self.postings[self.shard(entry.term)].read(entry.offset, entry.length))
+
+    def get_value(self, entry: LexiconEntry):
+        return self.posting_list(entry).postings()
+
+    def entry(self, key: str) -> Optional[LexiconEntry]:
+        return self.lexicons[self.shard(key)].get(key)
+
+    def entries(self) -> Iterator[LexiconEntry]:
+        """Iterate over the lexicon entries of all terms, in order."""
+        for lexicon in self.lexicons:
+            yield from lexicon
+
+    def __len__(self) -> int:
+        return sum(len(lexicon) for lexicon in self.lexicons)
 
     def __getitem__(self, key: str):
-        i = self.line_offset.get(key, "")
-        return self.get_value(i) if i else []
+        entry = self.entry(key)
+        return self.get_value(entry) if entry else []
+
+
+class Segment:
+    def __init__(self, path: str) -> None:
+        """Reader for the segment (see index.segments) in the directory path: its index, document
+        lengths, urls and metadata. Its docids are in [base, end). Picklable."""
+        self.path = path
+        self.meta = load_meta(os.path.join(path, "meta"))
+        self.base: int = self.meta.get("base", 0)
+        self.end: int = self.meta.get("end", self.base + self.meta["N"])
+        self.index = Index(os.path.join(path, "index"))
+        self.lengths = Lengths(os.path.join(path, "lengths"), self.base)
+        self.urls = UrlStore(os.path.join(path, "urls"))
+
+    def url(self, docid: int) -> str:
+        return self.urls[docid - self.base]
+
+    def close(self):
+        self.index.close()
+        self.lengths.close()
+        self.urls.close()
+
+
+def open_segments(index_path: str) -> List[Segment]:
+    """Readers for the segments of the index in index_path's directory, in docid order."""
+    directory = os.path.dirname(index_path)
+    return [Segment(os.path.normpath(os.path.join(directory, name))) for name in read_manifest(directory)]
+
+
+def export_text(index_path: str, out_path: str) -> None:
+    """Export a binary index to the text format, with one `token: [(id,count),...]` line per term.
+
+    Args:
+        index_path (str): Path to the binary index.
+        out_path (str): Path to write the text index to.
+    """
+    index = Index(index_path)
+    with open(out_path, "w", encoding="UTF-8") as out:
+        for entry in index.entries():
+            out.write(f"{entry.term}: [")
+            out.write(",".join([f"({id},{count})" for id, count in index.get_value(entry)]))
+            out.write("]\n")
+    index.close()
+
 
 class PartialIndex:
-    def __init__(self, index_path: str, terms: List[str]) -> None:
+    def __init__(self, index: Index, terms: List[str]) -> None:
         """ Constructs a PartialIndex, which is an index containing the terms provided as a parameter.
          """
-        with open(index_path, "r", encoding="UTF-8") as idfp:
-            self.set_index(idfp, terms)
-
-
-    def set_index(self, file: TextIO, terms: List[str]):
-        """Creates a dictionary that maps terms to a dictionary that maps docids to counts. O(filesize)"""
-        self.index = {}
-        for line in file:
-            split = line.index(":")
-            term = line[:split]
-            if term in terms:
-                self.index[term] = dict(ast.literal_eval(line[split + 1 :]))
+        self.set_index(index, terms)
+
+    def set_index(self, index: Index, terms: List[str]):
+        """Creates a dictionary that maps terms to their posting lists. Only the lexicon entries and
+        the skip entries of the terms are read, blocks are decoded as cursors reach them.
+        O(len(terms) log nterms)"""
+        self.index: Dict[str, PostingList] = {}
+        self.entries = {}
+        for term in terms:
+            entry = index.entry(term)
+            if entry:
+                self.entries[term] = entry
+                self.index[term] = index.posting_list(entry)
+
+    def df(self, key: str) -> int:
+        entry = self.entries.get(key)
+        return entry.df if entry else 0
 
     def __getitem__(self, key: str):
         # O(1)
@@ -1,17 +1,16 @@
-import math
-import os
 import re
-from statistics import mean
+from bisect import bisect_right
 from time import time
-from typing import Dict, List, Set
+from typing import Callable, Dict, Iterator, List, Optional, Set
 
 from joblib import Parallel, delayed
 from nltk_light import download, word_tokenize
-from nltk_light.stem import RSLPStemmer
 
-from index.util import ignored_words
+from index.blocks import Impacts, PostingCursor, bm25_idf, bm25_tf, tfidf_idf
+from index.stemmer import CachedStemmer
+from index.util import fast_tokenize, ignored_words
 
-from .index import PartialIndex
+from .index import PartialIndex, open_segments
 from .logger import Logger
 from .structs import PriorityQueue
 
@@ -31,44 +30,44 @@ class QueryProcessor:
         self.qpath = qpath
         self.ipath = ipath
         self.rfunc = self.bm25_query if rfunc == "BM25" else self.tf_idf_query
-        self.load_urls()
+        self.segments = open_segments(ipath)
+        self.bases = [segment.base for segment in self.segments]
         self.load_count()
-        self.mean_len = mean(self.count.values())
-        self.stemmer = RSLPStemmer()
+        self.stemmer = CachedStemmer()
+        # Queries are tokenized like the documents of the index were, see index.index_manager.analyzer_config.
+        self.fast = self.segments[0].meta.get("analyzer", {}).get("tokenizer") == "fast" if self.segments else False
         self.logger = Logger()
 
     def load_count(self):
-        """Load the term count file. O(countsize)"""
-        print("Loading counts...")
-
-        self.count: Dict[int, int] = {}
-        cpath = os.path.join(''.join(os.path.split(self.ipath)[:-1]), "count")
-        with open(cpath, "r", encoding="UTF-8") as ufile:
-            for line in ufile:
-                split = line.index(":")
-                self.count[int(line[:split])] = int(line[split + 1 :])
-
-    def load_urls(self):
-        """Load the urls mapping file, that maps documentids to their respective urls. O(urlssize)"""
-        print("Loading urls...")
-        self.urls: Dict[int, str] = {}
-        urls_path = os.path.join(''.join(os.path.split(self.ipath)[:-1]), "url_index")
-        with open(urls_path, "r", encoding="UTF-8") as ufile:
-            for line in ufile:
-                split = line.index(":")
-                self.urls[int(line[:split])] = line[split + 1 :]
-
-    def tf(self, term: str, document: int) -> float:
-        """Compute the term frequency for the specified term and document.
+        """Load the collection statistics from the metadata of the segments. O(nsegments)"""
+        self.N: int = sum(segment.meta["N"] for segment in self.segments)
+        self.mean_len: float = sum(segment.meta["total_tokens"] for segment in self.segments) / (self.N or 1)
+        # Impacts are quantized with the statistics of their segment, so they are only used when
+        # there is a single one. Otherwise lists with impacts are pruned by the maximum term frequency
+        # components of their blocks, like the others.
+        self.impacts: Optional[Impacts] = None
+        if len(self.segments) == 1 and self.segments[0].meta.get("impacts"):
+            self.impacts = Impacts(**self.segments[0].meta["impacts"])
+
+    def url(self, document: int) -> str:
+        """Url of the document, from the segment that holds it. O(log nsegments)"""
+        return self.segments[bisect_right(self.bases, document) - 1].url(document)
+
+    def df(self, term: str) -> int:
+        """Number of documents containing the term, over all segments."""
+        return sum(index.df(term) for index in self.indexes)
+
+    def tf(self, count: int, document: int) -> float:
+        """Compute the term frequency of a term that appears count times in the document.
 
         Args:
-            term (str): Term to compute the term frequency of.
+            count (int): Count of the term in the document.
             document (int): Document id of the document to compute the term frequency on.
 
         Returns:
             float: Term frequency.
         """
-        return self.index[term][document] / self.count[document]
+        return count / self.count[document]
 
     def idf(self, term: str) -> float:
         """Compute the inverse document frequency of the term.
@@ -79,35 +78,21 @@ class QueryProcessor:
         Returns:
             float: inverse document frequency.
         """
-        n = len(self.urls)
-        div = len(self.index[term]) or math.inf
-        return math.log(n / div)
+        return tfidf_idf(self.dfs[term], self.N)
 
     # https://en.wikipedia.org/wiki/Tf%E2%80%93idf
-    def tf_idf(self, term: str, document: int) -> float:
+    def tf_idf(self, term: str, count: int, document: int) -> float:
         """Compute the TF-IDF of the term over the document.
 
         Args:
             term (str): Term
+            count (int): Count of the term in the document.
             document (int): document id
 
         Returns:
             float: TF-IDF
         """
-        return self.tf(term, document) * self.idf(term)
-
-    def has_term(self, term: str, document: int) -> bool:
-        """Checks if the document "document" has the term "term".
-
-        Args:
-            term (str): Term to check.
-            document (int): Document to check.
-
-        Returns:
-            bool: If the document has the term.
-        """
-
-        return document in self.index[term]
+        return self.tf(count, document) * self.idf(term)
 
     def tf_idf_query(self, query: List[str]) -> PriorityQueue:
         """Compute the total TF-IDF over all terms in the query.
@@ -118,16 +103,52 @@ class QueryProcessor:
         Returns:
             PriorityQueue: Priority queue containing the top 10 documents.
         """
-        relevants: Set[int] = self.get_relevants(query)
-        res = PriorityQueue(maxsize=10)
+        return self.top_k(query, self.tf_idf, self.idf, "tfidf")
 
-        for document in relevants:
-            total = 0
-            for token in query:
-                total += self.tf_idf(token, document)
-            res.put((total, document))
+    def cursors(self, query: List[str]) -> Dict[str, PostingCursor]:
+        """Cursors over the posting lists of the distinct terms of query, ordered by increasing
+        document frequency. Empty if any term is not in the index, since no document can match."""
+        terms = sorted(set(query), key=lambda x: len(self.index[x]))
+        if not terms or not len(self.index[terms[0]]):
+            return {}
+        return {term: self.index[term].cursor() for term in terms}
 
-        return res
+    def matches(self, cursors: List[PostingCursor], prune: Optional[Callable[[], bool]] = None) -> Iterator[int]:
+        """Conjunctive document-at-a-time matching. The cursor of the rarest term leads, the others
+        are moved to the first docid >= the candidate, skipping whole blocks through their skip
+        entries without decoding them.
+
+        Args:
+            cursors (List[PostingCursor]): Cursors ordered by increasing document frequency.
+            prune (Callable[[], bool], optional): Called with every cursor on the block that may hold
+                the next match, returns True if no document in those blocks can make it into the
+                results, in which case they are skipped.
+
+        Yields:
+            int: Ids of the documents that contain every term, in increasing order.
+        """
+        lead, others = cursors[0], cursors[1:]
+        target = 0
+        while True:
+            if prune is not None:
+                if not all(cursor.seek_block(target) for cursor in cursors):
+                    return
+                if prune():
+                    target = min(cursor.block_last() for cursor in cursors) + 1
+                    continue
+            document = lead.next_geq(target)
+            if document is None:
+                return
+            for cursor in others:
+                found = cursor.next_geq(document)
+                if found is None:
+                    return
+                if found != document:
+                    target = found
+                    break
+            else:
+                yield document
+                target = document + 1
 
     def get_relevants(self, query: List[str]) -> Set[int]:
         """Get the relevant documents for a query by performing a conjunctive
@@ -140,15 +161,80 @@ class QueryProcessor:
             Set[int]: Set of relevant document ids.
         """
         relevants: Set[int] = set()
-        for document in self.urls:
-            for token in sorted(query, key=lambda x: len(self.index[x])):
-                if not self.has_term(token, document):
-                    break
-            else:
-                relevants.add(document)
-
+        for index in self.indexes:
+            self.index = index
+            cursors = self.cursors(query)
+            if cursors:
+                relevants.update(self.matches(list(cursors.values())))
         return relevants
 
+    def top_k(
+        self,
+        query: List[str],
+        score: Callable[[str, int, int], float],
+        idf: Callable[[str], float],
+        kind: str,
+    ) -> PriorityQueue:
+        """Top 10 documents matching every term of query, with dynamic pruning: once there are 10
+        results, blocks whose maximum scores (see index.blocks) add up to less than the 10th best
+        score are skipped, since none of their documents can make it into the results.
+
+        If the index stores impacts, documents are scored by adding up the scores of the impacts of
+        their postings instead (see index.blocks.Impacts).
+
+        Segments are searched one after the other, sharing the results, so a segment starts with the
+        threshold left by the previous ones. The BM25 block maximums of a segment were computed with
+        its own average document length, they are scaled so they stay upper bounds with the
+        collection's.
+
+        Args:
+            query (List[str]): Search query.
+            score (Callable[[str, int, int], float]): Score of a term given its count and the document.
+            idf (Callable[[str], float]): idf of a term, that multiplies its block maximums.
+            kind (str): Block maximums to use, "bm25" or "tfidf".
+
+        Returns:
+            PriorityQueue: Top 10 documents.
+        """
+        res = PriorityQueue(maxsize=10)
+        if not all(self.dfs.get(term) for term in query):
+            return res
+        if self.impacts:
+            values = self.impacts.values(kind)
+            weights = {term: query.count(term) for term in set(query)}
+        else:
+            values = None
+            weights = {term: query.count(term) * idf(term) for term in set(query)}
+
+        for segment, index in zip(self.segments, self.indexes):
+            self.index = index
+            cursors = self.cursors(query)
+            if not cursors:
+                continue
+            self.count = segment.lengths
+            correction = 1.0
+            if kind == "bm25" and not self.impacts:
+                # bm25_tf grows by at most avgdl' / avgdl when avgdl grows to avgdl'.
+                correction = max(1.0, self.mean_len / segment.meta["avgdl"])
+
+            def prune() -> bool:
+                if not res.full():
+                    return False
+                if values:
+                    bound = sum(
+                        weight * values[cursors[term].block_max_impact(kind)] for term, weight in weights.items()
+                    )
+                else:
+                    bound = sum(weight * cursors[term].block_max(kind) for term, weight in weights.items())
+                return bound * correction < res.min()[0]
+
+            for document in self.matches(list(cursors.values()), prune):
+                if self.impacts:
+                    res.put((sum(values[cursors[token].impact(kind)] for token in query), document))
+                else:
+                    res.put((sum(score(token, cursors[token].count, document) for token in query), document))
+        return res
+
     def bm_idf(self, term: str) -> float:
         """IDF for the BM25 ranking function.
 
@@ -158,31 +244,21 @@ class QueryProcessor:
         Returns:
             float: IDF of the term.
         """
-        N = len(self.urls)
-        n = len(self.index[term])
-        return math.log(((N - n + 0.5) / (n + 0.5)) + 1)
+        return bm25_idf(self.dfs[term], self.N)
 
     # https://en.wikipedia.org/wiki/Okapi_BM25
-    def bm25(self, document: int, query: List[str]) -> float:
-        """Compute the BM25 score of the query on the document.
+    def bm25(self, term: str, count: int, document: int) -> float:
+        """Compute the BM25 score of a term of the query on the document.
 
         Args:
+            term (str): Term of the query.
+            count (int): Count of the term in the document.
             document (int): Document to compute the score of.
-            query (List[str]): Search query.
 
         Returns:
-            float: BM25 of the document.
+            float: BM25 of the term in the document.
         """
-        score = 0
-        k1 = 1.5
-        b = 0.75
-        for token in query:
-            score += self.bm_idf(token) * (
-                self.tf(token, document)
-                * (k1 + 1)
-                / (self.tf(token, document) + k1 * (1 - b + (b * (self.count[document] / self.mean_len))))
-            )
-        return score
+        return self.bm_idf(term) * bm25_tf(self.tf(count, document), self.count[document], self.mean_len)
 
     def bm25_query(self, query: List[str]) -> PriorityQueue:
         """Compute the BM25 score of all relevant documents.
@@ -194,12 +270,7 @@ class QueryProcessor:
         Returns:
             PriorityQueue: Top 10 documents.
         """
-        relevants: Set[int] = self.get_relevants(query)
-        res = PriorityQueue(maxsize=10)
-        for document in relevants:
-            res.put((self.bm25(document, query), document))
-
-        return res
+        return self.top_k(query, self.bm25, self.bm_idf, "bm25")
 
     def process_query(self, query: str) -> PriorityQueue:
         """Tokenize, stem and remove stopwords of query.
@@ -211,7 +282,8 @@ class QueryProcessor:
             PriorityQueue: Top 10 documents.
         """
         preprocessed_query = self.preprocess_query(query)
-        self.index = PartialIndex(self.ipath, preprocessed_query)
+        self.indexes = [PartialIndex(segment.index, preprocessed_query) for segment in self.segments]
+        self.dfs = {term: self.df(term) for term in preprocessed_query}
         return self.rfunc(preprocessed_query)
 
     def preprocess_query(self, query: str) -> List[str]:
@@ -223,9 +295,12 @@ class QueryProcessor:
         Returns:
             List[str]: Processed tokens
         """
-        tokens = word_tokenize(query, "portuguese")
-        tokens = filter(lambda word: not re.search(r"[^\w]|[\d]|\_", word), tokens)
-        tokens = filter(lambda word: word not in ignored_words, tokens)
+        if self.fast:
+            _, tokens = fast_tokenize(query)
+        else:
+            tokens = word_tokenize(query, "portuguese")
+            tokens = filter(lambda word: not re.search(r"[^\w]|[\d]|\_", word), tokens)
+            tokens = filter(lambda word: word not in ignored_words, tokens)
         tokens = map(self.stemmer.stem, tokens)
         return list(tokens)
 
@@ -240,7 +315,7 @@ class QueryProcessor:
         e = time()
         out = {}
         out["Query"] = query.strip()
-        out["Results"] = [{"URL": self.urls[document][2:-3], "Score": score} for score, document in res]
+        out["Results"] = [{"URL": self.url(document), "Score": score} for score, document in res]
         self.logger.add_message(f"{e-s},")
 
     def process_queries(self):
@@ -20,6 +20,13 @@ class PriorityQueue:
     def empty(self):
         return not self.h
 
+    def full(self):
+        return len(self.h) >= self.maxsize
+
+    def min(self):
+        """Smallest element, the one the next put would replace if the queue is full."""
+        return self.h[0]
+
     def __iter__(self):
         h = sorted(self.h, reverse=True)
         for elem in h:
@@ -0,0 +1,149 @@
+import math
+import os
+import random
+
+import pytest
+
+from index.blocks import STEP, Impacts, bm25_idf, bm25_tf, tfidf_idf
+from index.file_buffer import RunWriter
+from index.meta import write_index_meta, write_lengths
+from index.partial_index import merge_indexes
+from index.segments import write_manifest
+from index.url_store import UrlStoreWriter
+from query import query_processor
+from query.index import Index
+from query.query_processor import QueryProcessor
+
+NDOCS = 400
+TERMS = [f"t{i}" for i in range(30)]
+QUERIES = ["t0", "t1", "t3", "t0 t1", "t1 t2", "t0 t4", "t2 t5 t0", "t7", "t1 t1 t3"]
+# A posting's impact is off by at most half a step, so is a sum of them.
+TOLERANCE = math.sqrt(STEP) * (1 + 1e-9)
+
+
+def collection(seed=0):
+    """Documents as term counts, with Zipfian terms and lengths from 1 to 2000 tokens. The one token
+    documents make the largest possible posting scores, the ones linear impacts were scaled to."""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(TERMS))]
+    docs = []
+    for docid in range(NDOCS):
+        length = 1 if docid % 50 == 7 else rng.randint(20, 2000)
+        counts = {}
+        for term in rng.choices(TERMS, weights, k=length):
+            counts[term] = counts.get(term, 0) + 1
+        docs.append(counts)
+    return docs
+
+
+def build(out, docs, impacts, base=0, end=NDOCS):
+    """Index docs[base:end] in out the way index_manager does: a run, the lengths and metadata, then the merge."""
+    runs = os.path.join(out, "runs")
+    os.makedirs(runs)
+    postings = {}
+    for docid in range(base, end):
+        for term, count in docs[docid].items():
+            postings.setdefault(term, []).append((docid, count))
+    with RunWriter(os.path.join(runs, f"{base}_{end}")) as run:
+        for term in sorted(postings):
+            run.add(term, postings[term])
+    lengths = [(docid, sum(docs[docid].values())) for docid in range(base, end)]
+    ndocs, ntokens = write_lengths(os.path.join(out, "lengths"), lengths, base)
+    with UrlStoreWriter(os.path.join(out, "urls")) as urls:
+        for docid in range(base, end):
+            urls.add(f"http://example.com/{docid}")
+    quantization = write_index_meta(out, ndocs, ntokens, base, end, {}, "vbyte", impacts)
+    merge_indexes(runs, impacts=quantization, out=out)
+
+
+@pytest.fixture(scope="module")
+def processors(tmp_path_factory):
+    docs = collection()
+    exact, impacts = tmp_path_factory.mktemp("exact"), tmp_path_factory.mktemp("impacts")
+    build(str(exact), docs, False)
+    build(str(impacts), docs, True)
+    # Segments with impacts, which are not used across segments.
+    segments = tmp_path_factory.mktemp("segments")
+    for name, base, end in (("0", 0, NDOCS // 2), ("1", NDOCS // 2, NDOCS)):
+        build(os.path.join(segments, name), docs, True, base, end)
+    write_manifest(str(segments), ["0", "1"])
+    return docs, str(exact), str(impacts), str(segments)
+
+
+def open_processor(monkeypatch, path, rfunc):
+    monkeypatch.setattr(query_processor, "download", lambda *args: None)
+    monkeypatch.setattr(query_processor, "Logger", lambda: None)
+    processor = QueryProcessor(os.path.join(path, "index"), "", rfunc)
+    processor.preprocess_query = str.split
+    return processor
+
+
+def exact_score(docs, query, docid, rfunc):
+    length = sum(docs[docid].values())
+    avgdl = sum(sum(counts.values()) for counts in docs) / len(docs)
+    score = 0.0
+    for term in query.split():
+        df = sum(term in counts for counts in docs)
+        tf = docs[docid][term] / length
+        if rfunc == "BM25":
+            score += bm25_idf(df, len(docs)) * bm25_tf(tf, length, avgdl)
+        else:
+            score += tfidf_idf(df, len(docs)) * tf
+    return score
+
+
+def test_quantization_error():
+    impacts = Impacts(1000, 10.0, 10.0)
+    values = impacts.values("bm25")
+    for score in (10.0, 3.3, 0.5, 0.01, 10.0 / 2**19):
+        assert score / TOLERANCE <= values[impacts.quantize(score, 10.0)] <= score * TOLERANCE
+    assert impacts.quantize(0.0, 10.0) == 0
+    assert impacts.quantize(1e-12, 10.0) == 1
+
+
+@pytest.mark.parametrize("rfunc", ["BM25", "TFIDF"])
+def test_impacts_rank_like_exact_scores(monkeypatch, processors, rfunc):
+    docs, exact_path, impacts_path, _ = processors
+    exact = open_processor(monkeypatch, exact_path, rfunc)
+    impacts = open_processor(monkeypatch, impacts_path, rfunc)
+    assert exact.impacts is None and impacts.impacts is not None
+    for query in QUERIES:
+        expected = sorted(exact.process_query(query), reverse=True)
+        results = sorted(impacts.process_query(query), reverse=True)
+        assert len(results) == len(expected) == 10
+        for score, docid in expected:
+            assert score == pytest.approx(exact_score(docs, query, docid, rfunc))
+        for score, docid in results:
+            assert exact_score(docs, query, docid, rfunc) / TOLERANCE <= score
+            assert score <= exact_score(docs, query, docid, rfunc) * TOLERANCE
+        # A document can only take the place of another if their scores are within the error of the impacts.
+        tenth = expected[-1][0]
+        for score, docid in results:
+            assert exact_score(docs, query, docid, rfunc) >= tenth / TOLERANCE**2
+        for (score, docid), (expected_score, expected_docid) in zip(results, expected):
+            assert score == pytest.approx(expected_score, rel=TOLERANCE**2 - 1)
+
+
+@pytest.mark.parametrize("rfunc", ["BM25", "TFIDF"])
+def test_segments_with_impacts_score_exactly(monkeypatch, processors, rfunc):
+    docs, exact_path, _, segments_path = processors
+    exact = open_processor(monkeypatch, exact_path, rfunc)
+    segments = open_processor(monkeypatch, segments_path, rfunc)
+    assert len(segments.segments) == 2 and segments.impacts is None
+    for query in QUERIES:
+        expected = sorted(exact.process_query(query), reverse=True)
+        results = sorted(segments.process_query(query), reverse=True)
+        assert [docid for _, docid in results] == [docid for _, docid in expected]
+        assert [score for score, _ in results] == pytest.approx([score for score, _ in expected])
+
+
+def test_impact_lists_keep_block_maximums(processors):
+    _, exact_path, impacts_path, _ = processors
+    exact, impacts = Index(os.path.join(exact_path, "index")), Index(os.path.join(impacts_path, "index"))
+    for entry in exact.entries():
+        plist, impact_plist = exact.posting_list(entry), impacts.posting_list(impacts.entry(entry.term))
+        assert impact_plist.has_impacts and not plist.has_impacts
+        assert impact_plist.bm25_max == plist.bm25_max and impact_plist.tfidf_max == plist.tfidf_max
+        assert len(impact_plist.bm25_impact_max) == len(impact_plist.tfidf_impact_max) == len(plist.lasts)
+    exact.close()
+    impacts.close()
@@ -0,0 +1,53 @@
+import os
+
+from benchmark import rule_words
+from index.stemmer import CachedStemmer, CompiledRSLP, Vocabulary
+from nltk_light.stem import RSLPStemmer
+
+# Inflected forms of common Portuguese nouns, adjectives and verbs, one per line.
+WORDS = os.path.join(os.path.dirname(__file__), "data", "portuguese.txt")
+
+
+def words():
+    with open(WORDS, "r", encoding="UTF-8") as f:
+        return f.read().split()
+
+
+def test_compiled_rslp_stems_like_rslp():
+    reference = RSLPStemmer()
+    compiled = CompiledRSLP(reference)
+    mismatches = [word for word in rule_words(reference) + words() if compiled.stem(word) != reference.stem(word)]
+    assert not mismatches
+
+
+def test_cached_stemmer_stems_like_rslp():
+    reference = RSLPStemmer()
+    stemmer = CachedStemmer()
+    sample = words()[::7]
+    # Twice, so the second pass is answered by the cache.
+    for word in sample + sample:
+        assert stemmer.stem(word) == reference.stem(word)
+    assert stemmer.hits and stemmer.misses
+
+
+def test_vocabulary_keeps_the_most_frequent_words(tmp_path):
+    path = str(tmp_path / "vocabulary")
+    vocabulary = Vocabulary(path, size=3)
+    first, second = CachedStemmer(), CachedStemmer()
+    for word in ["casa"] * 5 + ["gato"] * 4 + ["rato"] * 2 + ["pato"]:
+        first.stem(word)
+    for word in ["rato"] * 4 + ["cão"] * 3 + ["pato"]:
+        second.stem(word)
+    assert first.frequent(2) == [("casa", 5), ("gato", 4)]
+    vocabulary.add(first.frequent())
+    vocabulary.add(second.frequent())
+    vocabulary.save()
+    # Least frequent first, the last worker's words do not replace the others.
+    with open(path, "r", encoding="UTF-8") as f:
+        assert f.read().split() == ["gato", "casa", "rato"]
+
+    fresh = CachedStemmer()
+    fresh.load(path)
+    assert list(fresh.cache) == ["gato", "casa", "rato"] and not fresh.frequent()
+    fresh.stem("casa")
+    assert fresh.hits == 1 and fresh.frequent() == [("casa", 1)]
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from index.util import get_visible, get_visible_soup
+from index.visible import iter_visible
+
+PAGES = os.path.join(os.path.dirname(__file__), "data", "visible")
+
+
+def read_page(name):
+    with open(os.path.join(PAGES, name), "r", encoding="UTF-8") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("name", sorted(os.listdir(PAGES)))
+def test_visible_matches_soup(name):
+    html = read_page(name)
+    assert get_visible(html) == get_visible_soup(html)
+
+
+@pytest.mark.parametrize("name", sorted(os.listdir(PAGES)))
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_visible_does_not_depend_on_chunks(name, chunk_size):
+    html = read_page(name)
+    assert " ".join(iter_visible(html, chunk_size)) == get_visible_soup(html)
+
+
+def test_visible_drops_hidden_text():
+    text = get_visible(read_page("hidden.html"))
+    assert "Visível antes do estilo" in text and "Parágrafo em maiúsculas" in text
+    assert "escondido" not in text.replace("escondido por css", "")
+    assert "var texto" not in text and "Conteúdo de template" not in text